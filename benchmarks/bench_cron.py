@@ -0,0 +1,37 @@
+from os.path import join
+
+from scflows.config import config
+from scflows.cron import parsetabfiles, savetabfiles, TabfileCache
+
+from common import timer, make_tabfile, device_task
+
+def run(results, sizes, ops, directory):
+    '''
+        Tabfile parsing and saving, as done by the web app on each request
+    '''
+    for size in sizes:
+        make_tabfile(join(directory, f'{config._tabfile}.tab'), size)
+
+        with timer() as t:
+            tabfiles = parsetabfiles(path=directory)
+        results.add('cron', 'parsetabfiles', size, t['seconds'])
+
+        cache = TabfileCache()
+
+        with timer() as t:
+            cache.parse(directory)
+        results.add('cron', 'TabfileCache.parse (cold)', size, t['seconds'])
+
+        with timer() as t:
+            for _ in range(ops):
+                cache.parse(directory)
+        results.add('cron', 'TabfileCache.parse (warm)', size, t['seconds'], ops)
+
+        with timer() as t:
+            for device in range(ops):
+                cache.job(directory, config._tabfile, device_task(device * (size // ops))[0].name)
+        results.add('cron', 'TabfileCache.job', size, t['seconds'], ops)
+
+        with timer() as t:
+            savetabfiles(tabfiles=tabfiles, path=directory)
+        results.add('cron', 'savetabfiles', size, t['seconds'])
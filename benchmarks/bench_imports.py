@@ -0,0 +1,75 @@
+from os.path import join, dirname, abspath
+import subprocess
+import os
+import sys
+from time import perf_counter
+
+root = dirname(dirname(abspath(__file__)))
+
+# Entry points of the tasks, the dispatcher, the worker and the web app
+modules = [
+    'scflows.tasks.dprocess',
+    'scflows.tasks.dbackup',
+    'scflows.tasks.dschedule',
+    'scflows.tasks.dispatcher',
+    'scflows.worker',
+    'scflows.main'
+]
+
+# Scripts started by cron, up to parsing their options
+scripts = [
+    join('scflows', 'tasks', 'dprocess.py'),
+    join('scflows', 'tasks', 'dbackup.py')
+]
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    # The worker needs these, but never connects
+    env.setdefault('CELERY_BROKER', 'memory://')
+    env.setdefault('CELERY_RESULTS_BACKEND', 'cache+memory://')
+    env.setdefault('CELERY_TIMEZONE', 'UTC')
+    return env
+
+def importtime(module, env):
+    '''
+        Cumulative import time of module in a fresh interpreter, in
+        seconds, from python -X importtime. None if it can't be imported
+    '''
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=root, env=env)
+    if process.returncode != 0: return None
+
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module and not fields[2].startswith('  '):
+            return int(fields[1]) / 1e6
+    return None
+
+def run(results, ops):
+    '''
+        Import time of the entry points and start up time of the task scripts
+    '''
+    env = environment()
+    repeats = max(1, min(ops, 10))
+
+    for module in modules:
+        timings = [importtime(module, env) for _ in range(repeats)]
+        if None in timings:
+            print(f'Skipping {module}: not importable here')
+            continue
+        # Best of the repeats, the rest is noise of the machine
+        results.add('imports', module, 1, min(timings))
+
+    for script in scripts:
+        timings = []
+        for _ in range(repeats):
+            start = perf_counter()
+            process = subprocess.run([sys.executable, script, '--help'],
+                capture_output=True, cwd=root, env=env)
+            timings.append(perf_counter() - start)
+        if process.returncode != 0:
+            print(f'Skipping {script}: {process.stderr.decode().strip().splitlines()[-1:]}')
+            continue
+        results.add('imports', f'{script} --help', 1, min(timings))
@@ -0,0 +1,65 @@
+from os.path import join
+
+from scflows.config import config
+from scflows.tasks.scheduler import Scheduler
+
+from common import timer, device_task, make_tabfile
+
+def run(results, sizes, ops, directory):
+    '''
+        Scheduler operations on tabfiles of each size. Operations on
+        single tasks are repeated ops times
+    '''
+    for size in sizes:
+        tabfile = join(directory, f'{config._tabfile}.tab')
+        make_tabfile(tabfile, size)
+
+        with timer() as t:
+            s = Scheduler(tabfile)
+        results.add('scheduler', 'init', size, t['seconds'])
+
+        with timer() as t:
+            for device in range(ops):
+                s.check_existing_task(device_task(device * (size // ops))[0])
+        results.add('scheduler', 'check_existing_task', size, t['seconds'], ops)
+
+        with timer() as t:
+            s.check_slots('hourly')
+        results.add('scheduler', 'check_slots (first, builds occupancy)', size, t['seconds'])
+
+        with timer() as t:
+            for _ in range(ops):
+                s.check_slots('hourly')
+        results.add('scheduler', 'check_slots', size, t['seconds'], ops)
+
+        new = [device_task(size + device) for device in range(ops)]
+
+        with timer() as t:
+            for task, log in new:
+                s.schedule_task(task=task, log=log, interval='3H', load_balancing=True)
+        results.add('scheduler', 'schedule_task (load balancing)', size, t['seconds'], ops)
+
+        with timer() as t:
+            with s.session():
+                for task, log in device_task_range(size, ops):
+                    s.schedule_task(task=task, log=log, interval='3H', load_balancing=True)
+        results.add('scheduler', 'schedule_task (load balancing, session)', size, t['seconds'], ops)
+
+        with timer() as t:
+            for task, _ in new:
+                s.remove_task(task)
+        results.add('scheduler', 'remove_task', size, t['seconds'], ops)
+
+        with timer() as t:
+            with s.session():
+                for task, _ in device_task_range(size, ops):
+                    s.remove_task(task)
+        results.add('scheduler', 'remove_task (session)', size, t['seconds'], ops)
+
+        with timer() as t:
+            s.clear_tasks()
+        results.add('scheduler', 'clear_tasks', size, t['seconds'])
+
+def device_task_range(size, ops):
+    # Tasks not in the synthetic tabfile, nor in the first ops added
+    return [device_task(size + ops + device) for device in range(ops)]
@@ -0,0 +1,110 @@
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import asyncio
+import json
+import os
+
+import mock_device
+from common import timer
+from scflows.config import config
+
+class S3Object(object):
+    # Last request a month ago, so that the backup goes ahead
+    days = 30
+
+    def get(self):
+        last = datetime.now(tz=timezone.utc) - timedelta(days=self.days)
+        return {'Body': BytesIO(json.dumps({'last_requested_data': last.isoformat()}).encode('UTF-8'))}
+
+    def put(self, Body):
+        return {}
+
+class S3(object):
+    def Object(self, bucket, key):
+        return S3Object()
+
+def run(results, devices, concurrency):
+    '''
+        dprocess and dbackup end to end with the mocked sc.Device
+    '''
+    # In case celery is imported, it's never used here
+    os.environ.setdefault('CELERY_BROKER', 'memory://')
+    os.environ.setdefault('CELERY_RESULTS_BACKEND', 'cache+memory://')
+    os.environ.setdefault('CELERY_TIMEZONE', 'UTC')
+    mock_device.install()
+
+    try:
+        import pyarrow
+    except ImportError as e:
+        print(f'Skipping the tail cache: {e}')
+        config._tail_cache_enabled = False
+
+    from scflows.tasks.dprocess import dprocess, dprocess_batch
+
+    async def sequential():
+        for device in range(devices):
+            await dprocess(device, dry_run=True)
+
+    with timer() as t:
+        asyncio.run(sequential())
+    results.add('tasks', 'dprocess', devices, t['seconds'], devices)
+
+    with timer() as t:
+        asyncio.run(dprocess_batch(list(range(devices)), dry_run=True, concurrency=concurrency))
+    results.add('tasks', f'dprocess_batch (concurrency {concurrency})', devices, t['seconds'], devices)
+
+    # Stopped by the pre-flight check, before creating the device
+    mock_device.new_data = False
+    with timer() as t:
+        asyncio.run(sequential())
+    results.add('tasks', 'dprocess (no new data)', devices, t['seconds'], devices)
+    mock_device.new_data = True
+
+    # A tenth of the devices, each with a backlog of 20 windows
+    behind = max(1, devices // 10)
+    mock_device.backlog = 20 * config._max_load_amount
+
+    async def catchup():
+        for device in range(behind):
+            await dprocess(device, dry_run=True, catchup=True)
+
+    with timer() as t:
+        asyncio.run(catchup())
+    results.add('tasks', f'dprocess --catchup ({mock_device.backlog} rows)', behind, t['seconds'], behind)
+    mock_device.backlog = None
+
+    try:
+        import boto3
+        from scflows.tasks.dbackup import dbackup
+    except ImportError as e:
+        print(f'Skipping dbackup: {e}')
+        return
+
+    os.environ.setdefault('S3_DATA_BUCKET', 'benchmarks')
+    boto3.resource = lambda *args, **kwargs: S3()
+
+    async def backups():
+        for device in range(devices):
+            await dbackup(device)
+
+    with timer() as t:
+        asyncio.run(backups())
+    results.add('tasks', 'dbackup', devices, t['seconds'], devices)
+
+    # A tenth of the devices, each a year behind
+    S3Object.days = 365
+
+    async def backup_catchup():
+        summaries = []
+        for device in range(behind):
+            _, _, summary = await dbackup(device, catchup=True, concurrency=concurrency)
+            summaries.append(summary['stages']['catchup'])
+        return summaries
+
+    with timer() as t:
+        summaries = asyncio.run(backup_catchup())
+    periods = sum(summary['windows'] for summary in summaries)
+    results.add('tasks', f'dbackup --catchup (concurrency {concurrency})', behind, t['seconds'], behind)
+    print(f"{periods} periods, {sum(summary['rows'] for summary in summaries)/t['seconds']:.0f} rows/s, "
+        f"{sum(summary['bytes'] for summary in summaries)/t['seconds']:.0f} bytes/s")
+    S3Object.days = 30
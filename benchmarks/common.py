@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os.path import join, dirname, abspath
+from os import makedirs
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import platform
+import subprocess
+import json
+import sys
+
+from numpy import random
+from crontab import CronTab
+
+from scflows.config import config
+from scflows.tasks.scheduler import Task
+
+class Results(object):
+    """
+        Timings of each benchmark, written as JSON to compare between versions
+    """
+    def __init__(self):
+        self.results = []
+
+    def add(self, group, name, size, seconds, ops = 1):
+        result = {
+            'group': group,
+            'name': name,
+            'size': size,
+            'ops': ops,
+            'seconds': round(seconds, 6),
+            'seconds_per_op': round(seconds/ops, 6)
+        }
+        print(f"{group:10} {name:40} {size:>7} {seconds:10.4f}s {seconds/ops*1e3:10.3f}ms/op")
+        self.results.append(result)
+
+    def write(self, path):
+        makedirs(dirname(abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump({
+                'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+                'revision': revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': self.results
+            }, file, indent=2)
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, cwd=dirname(abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+@contextmanager
+def timer():
+    timing = {}
+    start = perf_counter()
+    try:
+        yield timing
+    finally:
+        timing['seconds'] = perf_counter() - start
+
+def device_task(device):
+    # Same task and log as dschedule
+    task = Task(script=f'{config._device_processor}.py', options=[f'--device {device}'])
+    log = join(config.paths['log'], str(device), f'{config._device_processor}_{device}.log')
+    return task, log
+
+def make_tabfile(path, jobs, seed = 0):
+    '''
+        Writes a tabfile with as many device jobs as the scheduler would,
+        every 3 hours at random minutes
+    '''
+    rng = random.default_rng(seed)
+    with open(path, 'w') as file:
+        for device in range(jobs):
+            task, log = device_task(device)
+            minute, hour = rng.integers(60), rng.integers(3)
+            file.write(f"{minute} {hour},{hour+3},{hour+6},{hour+9},{hour+12},{hour+15},{hour+18},{hour+21} * * * "
+                f"{sys.executable} {task.instruction} >> {log} 2>&1 # {task.name}\n")
+
+@contextmanager
+def sandbox():
+    '''
+        Temporary tasks directory. The user crontab is never written
+    '''
+    paths = dict(config.paths)
+    write_to_user = CronTab.write_to_user
+    call = subprocess.call
+
+    with TemporaryDirectory() as directory:
+        config.paths['tabs'] = directory
+        config.paths['public'] = directory
+        config.paths['log'] = join(directory, 'log')
+        CronTab.write_to_user = lambda self, user = True: None
+        subprocess.call = lambda *args, **kwargs: 0
+        try:
+            yield directory
+        finally:
+            config.paths.update(paths)
+            CronTab.write_to_user = write_to_user
+            subprocess.call = call
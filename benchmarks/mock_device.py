@@ -0,0 +1,105 @@
+'''
+    Stand-in for scdata, with the parts of sc.Device used by
+    dprocess and dbackup. Loads synthetic readings and posts nothing,
+    so that the control flow of the tasks can be timed without network
+'''
+from datetime import datetime, timedelta, timezone
+from types import ModuleType, SimpleNamespace
+import asyncio
+import time
+import sys
+
+from numpy import random
+from pandas import DataFrame, date_range
+
+# Simulated network latency of each load and post, in seconds
+latency = 0
+# Readings loaded by each device
+rows = 1000
+channels = ['NOISE_A', 'TEMP', 'HUM', 'PM_1', 'PM_25', 'PM_10']
+# Readings after the latest postprocessing, in the metadata of the pre-flight check
+new_data = True
+# Readings pending for catch-up, loaded in windows of options.limit. None to load rows at once
+backlog = None
+end = datetime.now(tz=timezone.utc).replace(second=0, microsecond=0)
+
+class APIParams(object):
+    def __init__(self, id):
+        self.id = id
+
+class Metric(object):
+    def __init__(self, name, channel):
+        self.name = name
+        self.kwargs = {'channel': channel, 'window': 5}
+
+class Device(object):
+    def __init__(self, blueprint = None, params = None):
+        self.id = params.id
+        now = datetime.now(tz=timezone.utc)
+        self.handler = SimpleNamespace(
+            postprocessing = {'latest_postprocessing': None},
+            json = SimpleNamespace(created_at = now - timedelta(days=365), last_reading_at = end if backlog else now))
+        self.options = SimpleNamespace(min_date = None, max_date = None, channels = [], limit = None)
+        self.metrics = [Metric(f'{channel}_CLEAN', channel) for channel in channels]
+        self.valid_for_processing = True
+        self.data = DataFrame()
+        self.loaded = False
+        self.processed = False
+        self.postprocessing_updated = False
+
+    async def load(self):
+        await asyncio.sleep(latency)
+        if backlog is None:
+            index = date_range(end=datetime.now(tz=timezone.utc), periods=rows, freq='1min')
+        else:
+            index = date_range(end=end, periods=backlog, freq='1min')
+            if self.options.min_date is not None: index = index[index > self.options.min_date]
+            if self.options.max_date is not None: index = index[index <= self.options.max_date]
+            index = index[:self.options.limit]
+        self.data = DataFrame(random.rand(len(index), len(channels)), index=index, columns=channels)
+        if self.options.channels: self.data = self.data[[channel for channel in channels if channel in self.options.channels]]
+        self.loaded = not self.data.empty
+        return self.loaded
+
+    def process(self):
+        for metric in self.metrics:
+            self.data[metric.name] = self.data[metric.kwargs['channel']].rolling(metric.kwargs['window']).mean()
+        self.processed = True
+        return self.processed
+
+    def update_postprocessing_date(self):
+        self.handler.postprocessing['latest_postprocessing'] = self.data.index[-1]
+        self.postprocessing_updated = True
+
+    async def post(self, columns = 'sensors', dry_run = False, max_retries = 2, with_postprocessing = False):
+        await asyncio.sleep(latency)
+        return True
+
+    def backup(self, mode = 'overwrite'):
+        return True
+
+def metadata(device):
+    '''
+        Stand-in for preflight.device_metadata (SC API device JSON)
+    '''
+    time.sleep(latency)
+    now = datetime.now(tz=timezone.utc)
+    latest = now - timedelta(hours=3) if new_data else now
+    return {
+        'id': device,
+        'last_reading_at': (now - timedelta(minutes=1)).isoformat(),
+        'postprocessing': {'latest_postprocessing': latest.isoformat()}
+    }
+
+def install():
+    '''
+        Registers this module as scdata, and as the SC API of the
+        pre-flight check. Needs to run before importing the tasks
+    '''
+    sc = ModuleType('scdata')
+    sc.Device = Device
+    sc.APIParams = APIParams
+    sys.modules['scdata'] = sc
+
+    from scflows.tasks import preflight
+    preflight.device_metadata = metadata
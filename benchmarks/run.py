@@ -0,0 +1,84 @@
+from os.path import join, dirname, abspath
+from datetime import datetime
+import json
+import sys
+
+# Run from anywhere without installing the package
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from scflows.custom_logger import set_logger_level
+from common import Results, sandbox
+import mock_device
+
+def compare(results, path):
+    '''
+        Ratio of each timing against a previous results file
+    '''
+    with open(path) as file:
+        previous = {(r['group'], r['name'], r['size']): r for r in json.load(file)['results']}
+
+    print(f'Compared to {path}:')
+    for result in results.results:
+        key = (result['group'], result['name'], result['size'])
+        if key not in previous: continue
+        ratio = result['seconds_per_op'] / max(previous[key]['seconds_per_op'], 1e-9)
+        print(f"{result['group']:10} {result['name']:40} {result['size']:>7} {ratio:8.2f}x")
+
+if __name__ == '__main__':
+
+    if '-h' in sys.argv or '--help' in sys.argv or '-help' in sys.argv:
+        print('run: Benchmarks of the scheduler, the tabfile (web) paths, the tasks and their imports')
+        print('USAGE:\n\rrun.py [options]')
+        print('options:')
+        print('--only <groups>: comma separated groups to run, among scheduler, cron, tasks and imports (default: all)')
+        print('--sizes <sizes>: comma separated number of jobs in the synthetic tabfiles (default: 1000,10000,50000)')
+        print('--ops <ops>: repetitions of the operations on single tasks, and of the imports up to 10 (default: 100)')
+        print('--devices <devices>: devices to run through dprocess and dbackup (default: 100)')
+        print('--concurrency <concurrency>: devices at a time in dprocess_batch (default: 8)')
+        print('--latency <seconds>: simulated network latency of the mocked device load and post (default: 0)')
+        print('--rows <rows>: readings loaded by each mocked device (default: 1000)')
+        print('--output <file>: JSON results file (default: benchmarks/results/<timestamp>.json)')
+        print('--compare <file>: previous JSON results file to compare with')
+        sys.exit()
+
+    def option(name, default):
+        if name in sys.argv: return sys.argv[sys.argv.index(name)+1]
+        return default
+
+    groups = option('--only', 'scheduler,cron,tasks,imports').split(',')
+    sizes = [int(size) for size in option('--sizes', '1000,10000,50000').split(',')]
+    ops = int(option('--ops', 100))
+    devices = int(option('--devices', 100))
+    concurrency = int(option('--concurrency', 8))
+    mock_device.latency = float(option('--latency', 0))
+    mock_device.rows = int(option('--rows', 1000))
+    output = option('--output', join(dirname(abspath(__file__)), 'results',
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"))
+
+    # Logging of each operation would be timed otherwise
+    set_logger_level('ERROR')
+
+    results = Results()
+
+    with sandbox() as directory:
+        if 'scheduler' in groups:
+            import bench_scheduler
+            bench_scheduler.run(results, sizes, ops, directory)
+
+        if 'cron' in groups:
+            import bench_cron
+            bench_cron.run(results, sizes, ops, directory)
+
+        if 'tasks' in groups:
+            import bench_tasks
+            bench_tasks.run(results, devices, concurrency)
+
+        if 'imports' in groups:
+            import bench_imports
+            bench_imports.run(results, ops)
+
+    results.write(output)
+    print(f'Results written to {output}')
+
+    if '--compare' in sys.argv:
+        compare(results, option('--compare', None))
@@ -1,11 +1,19 @@
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
 from os import environ
 
-db = SQLAlchemy()
+# Flask is only imported by the web app, not by the tasks
+def __getattr__(name):
+    if name == 'db':
+        from flask_sqlalchemy import SQLAlchemy
+        global db
+        db = SQLAlchemy()
+        return db
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 def create_app():
+    from flask import Flask
+    from flask_login import LoginManager
+    from . import db
+
     app = Flask(__name__, template_folder='templates')
 
     app.config['SECRET_KEY'] = environ['FLASK_SECRET_KEY']
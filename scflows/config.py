@@ -5,16 +5,90 @@ class Config(object):
     _scheduler_interval_days = 1
     _device_scheduler = 'dschedule'
     _scheduler_log = 'scheduler.log'
+    # Devices checked at the same time when scheduling
+    _schedule_concurrency = 16
+    # Local snapshot of the devices for incremental scheduling runs
+    _device_snapshot = 'devices.sqlite'
+    _snapshot_full_run_interval_days = 7
+    _snapshot_overlap_minutes = 10
+    # Measured task durations, for load balancing
+    _task_durations = 'durations.sqlite'
+    _default_task_duration_seconds = 60
+    _task_duration_smoothing = 0.3
+
+    # Metrics shared by all processes, exposed in /metrics
+    _metrics = 'metrics.sqlite'
+    # Histogram buckets in seconds
+    _metrics_buckets = [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+    # History of the task runs, written in batches
+    _history = 'history.sqlite'
+    _history_batch_size = 50
+    _history_days = 7
+
+    # Columnar index of the task logs
+    _log_index = 'logindex'
+    # Parts merged into one when there are more
+    _log_index_parts = 50
+
+    # Dispatcher
+    _dispatcher = 'dispatcher'
+    _dispatcher_log = 'dispatcher.log'
+    _dispatcher_workers = 4
+    _dispatcher_poll_seconds = 30
 
     # Tasks
     _default_task_exec_interval_hours = 24
 
     _device_processor = 'dprocess'
     _postprocessing_task_exec_interval_hours = 3
+    # Devices per batch task and devices processed at the same time in it
+    _batch_size = 50
+    _batch_concurrency = 8
+    # Devices of each batch task (in paths['tabs'])
+    _batches = 'batches.json'
+    # Time budget of each device in catchup mode (dprocess --catchup), below the task interval
+    _catchup_budget_seconds = 30*60
+
+    # One metadata request before any scdata work, to skip devices with no new data
+    _preflight = True
+    _preflight_timeout_seconds = 10
+    # Overriden by the API_URL environment variable, as in smartcitizen_connector
+    _api_url = 'https://api.smartcitizen.me/v0/'
+
+    # Local cache of the readings loaded by dprocess and dbackup (in paths['public']),
+    # so that each range is only requested from the API once
+    _readings_cache_enabled = False
+    _readings_cache = 'readings'
+    # Least recently used days are evicted over this size
+    _readings_cache_max_bytes = 5*1024*1024*1024
+    # Readings of the last hours are always requested, they can be uploaded late
+    _readings_cache_refetch_hours = 72
+
+    # Last processed rows of each device (in paths['tabs']), for metrics with a lookback
+    _tail_cache_enabled = True
+    _tails = 'tails'
+    # Metric kwargs with the rows they look back, and minimum rows kept
+    _tail_lookback_kwargs = ['window', 'window_size', 'periods', 'lookback']
+    _tail_min_rows = 0
+
+    # Channels to load and order of the metrics, per postprocessing configuration
+    _plans = 'plans.sqlite'
+    _plan_ttl_hours = 24
+
+    # Post only the metric rows not posted yet or changed, in batches
+    _diff_posting = True
+    _posted = 'posted.sqlite'
+    # Hashes kept per device, to find changes in reloaded rows
+    _posted_rows = 5000
+    _post_batch_rows = 1000
 
     _device_storer = 'dbackup'
     _backup_task_exec_interval_hours = 6
     _backup_interval_days = 20
+    # Periods backed up at the same time and time budget in catchup mode (dbackup --catchup)
+    _backup_catchup_concurrency = 4
+    _backup_catchup_budget_seconds = 60*60
 
     paths = {
         'tasks': 'tasks',
@@ -24,7 +98,24 @@ class Config(object):
     }
 
     _tabfile = 'tabfile'
+
+    # Log rotation, checked when tasks start
+    _log_max_bytes = 10*1024*1024
+    _log_rotation_days = 30
+    _log_archives = 10
+    _log_compression_level = 6
+
+    # Log viewer
+    _log_page_bytes = 64*1024
+    # Live tail of manual runs
+    _log_tail_poll_seconds = 1
+    # Below the gunicorn worker timeout, the browser reconnects after it
+    _log_tail_seconds = 20
+    _log_tail_retry_ms = 1000
     _log_level = logging.INFO
+    # 'text' or 'json' (structured, written from a separate thread).
+    # Can be overriden with the SCFLOWS_LOG_FORMAT environment variable
+    _log_format = 'text'
     _timestamp = True
     _avoid_negative_conc = True
     _max_load_amount = 500
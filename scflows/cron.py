@@ -1,4 +1,4 @@
-from os import listdir
+from os import listdir, stat
 from os.path import join
 import traceback
 import sys
@@ -17,24 +17,31 @@ class CronThread(threading.Thread):
         self.job.run()
         self.status = 'done'
 
+def parsetabfile(file):
+    '''
+        Returns the record of each job in a tabfile, and the jobs themselves
+    '''
+    records = {}
+    cronjobs = {}
+    for job in CronTab(tabfile=file):
+        records[job.comment]=dict()
+        records[job.comment]['schedule']=job.slices
+        records[job.comment]['enabled']=job.is_enabled()
+        records[job.comment]['valid']=job.is_valid()
+        cl = job.command.split(' ')
+        records[job.comment]['who']=cl[0]
+        records[job.comment]['task']=' '.join(cl[1: cl.index('>>')])
+        records[job.comment]['logfile']=cl[cl.index('>>')+1:-1][0]
+        cronjobs[job.comment]=job
+    return records, cronjobs
+
 def parsetabfiles(path):
     tabfiles = {}
     try:
         for tabfile in listdir(path):
             if tabfile.endswith('.tab'):
                 tname = tabfile.replace('.tab', '')
-                tabfiles[tname]=dict()
-                jobs=CronTab(tabfile=join(path, tabfile))
-
-                for job in jobs:
-                    tabfiles[tname][job.comment]=dict()
-                    tabfiles[tname][job.comment]['schedule']=job.slices
-                    tabfiles[tname][job.comment]['enabled']=job.is_enabled()
-                    tabfiles[tname][job.comment]['valid']=job.is_valid()
-                    cl = job.command.split(' ')
-                    tabfiles[tname][job.comment]['who']=cl[0]
-                    tabfiles[tname][job.comment]['task']=' '.join(cl[1: cl.index('>>')])
-                    tabfiles[tname][job.comment]['logfile']=cl[cl.index('>>')+1:-1][0]
+                tabfiles[tname], _ = parsetabfile(join(path, tabfile))
         return tabfiles
     except IOError:
         traceback.print_exc()
@@ -43,6 +50,79 @@ def parsetabfiles(path):
         pass
     return {}
 
+class TabfileCache(object):
+    """
+        Parsed tabfiles, kept until their mtime or size change, and
+        indexed by (tabfile, comment) for single job lookups
+    """
+    def __init__(self):
+        self.files = {}
+        self.index = {}
+        self.cronjobs = {}
+        self.lock = threading.Lock()
+
+    def _load(self, path, tname):
+        # Re-parse the tabfile only if it changed
+        file = join(path, f'{tname}.tab')
+        try:
+            st = stat(file)
+        except FileNotFoundError:
+            self._drop(file)
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+
+        if file not in self.files or self.files[file][0] != key:
+            records, cronjobs = parsetabfile(file)
+            self._drop(file)
+            self.files[file] = (key, records)
+            for comment in records:
+                self.index[(file, comment)] = records[comment]
+                self.cronjobs[(file, comment)] = cronjobs[comment]
+
+        return self.files[file][1]
+
+    def _drop(self, file):
+        if file not in self.files: return
+        for comment in self.files.pop(file)[1]:
+            self.index.pop((file, comment), None)
+            self.cronjobs.pop((file, comment), None)
+
+    def parse(self, path):
+        '''
+            Same as parsetabfiles, only re-parsing the tabfiles that changed
+        '''
+        tabfiles = {}
+        try:
+            tnames = [tabfile.replace('.tab', '') for tabfile in listdir(path) if tabfile.endswith('.tab')]
+        except (FileNotFoundError, NotADirectoryError, TypeError):
+            return {}
+        with self.lock:
+            # Tabfiles deleted since the last parse
+            files = [join(path, f'{tname}.tab') for tname in tnames]
+            for file in [file for file in self.files if file.startswith(join(path, '')) and file not in files]:
+                self._drop(file)
+            for tname in tnames:
+                records = self._load(path, tname)
+                if records is not None: tabfiles[tname] = records
+        return tabfiles
+
+    def job(self, path, tabfile, cron):
+        '''
+            Record of a job, checking only its tabfile. None if not found
+        '''
+        file = join(path, f'{tabfile}.tab')
+        with self.lock:
+            self._load(path, tabfile)
+            return self.index.get((file, cron))
+
+    def cronjob(self, path, tabfile, cron):
+        file = join(path, f'{tabfile}.tab')
+        with self.lock:
+            self._load(path, tabfile)
+            return self.cronjobs.get((file, cron))
+
+tabcache = TabfileCache()
+
 def validate(schedule, who, task, log):
     c=CronTab(user=True)
 
@@ -61,16 +141,15 @@ def validate(schedule, who, task, log):
 
 def triggercrontab(path,tabfile,cron):
     print (f'Triggering {cron} from {tabfile}')
-    jobs=CronTab(tabfile=join(path, tabfile+'.tab'))
+    job=tabcache.cronjob(path, tabfile, cron)
 
-    for job in jobs:
-        if job.comment==cron:
-            if job.is_valid:
-                ct = CronThread(job)
-                ct.start()
-                return ct
-            else:
-                return False
+    if job is not None:
+        if job.is_valid():
+            ct = CronThread(job)
+            ct.start()
+            return ct
+        else:
+            return False
 
 def savetabfiles(tabfiles, path):
     for tabfile in tabfiles:
@@ -86,5 +165,7 @@ def savetabfiles(tabfiles, path):
             outputfile.write(line)
             outputfile.write('\n')
         outputfile.close()
-        subprocess.call(['crontab', join(path, f"{tabfile}.tab")])
+        # Only the dispatcher goes to the user crontab if there is one, it runs the rest
+        from scflows.tasks.scheduler import Scheduler
+        Scheduler(tabfile=join(path, f"{tabfile}.tab")).write()
     return 'Mierda de edit que has hecho'
\ No newline at end of file
@@ -1,6 +1,13 @@
 from termcolor import colored
 from scflows.config import config
 from datetime import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from os import environ, register_at_fork
+import atexit
+import json
 import sys
 import logging
 
@@ -22,17 +29,111 @@ class CutsomLoggingFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format_deb + reset
     }
 
+    # Built once per level, not on every record
+    FORMATTERS = {level: logging.Formatter(fmt) for level, fmt in FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.FORMATTERS.get(record.levelno, self.FORMATTERS[logging.INFO])
         return formatter.format(record)
 
+class JsonLoggingFormatter(logging.Formatter):
+    """
+        One JSON object per line, with the device, task and stage
+        of the record if known
+    """
+    fields = ['device', 'task', 'stage']
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        for field in self.fields:
+            if hasattr(record, field): entry[field] = getattr(record, field)
+        if record.levelno >= logging.ERROR:
+            entry['file'] = record.filename
+            entry['line'] = record.lineno
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif hasattr(record, 'exception'):
+            entry['exception'] = record.exception
+        return json.dumps(entry, default=str)
+
+class FieldsQueueHandler(QueueHandler):
+    """
+        Queues records with their traceback as a field, as
+        QueueHandler.prepare drops it (exc_info) before queuing
+    """
+    def prepare(self, record):
+        prepared = super().prepare(record)
+        # The message without the traceback, which goes in its own field
+        prepared.msg = prepared.message = record.getMessage()
+        if record.exc_info:
+            prepared.exception = logging.Formatter().formatException(record.exc_info)
+        return prepared
+
+# Device, task and stage being run, added to the records
+_fields = ContextVar('log_fields', default={})
+
+def set_log_fields(**fields):
+    '''
+        Adds fields to the records of the current context (i.e. the
+        asyncio task of a device)
+    '''
+    _fields.set({**_fields.get(), **fields})
+
+@contextmanager
+def log_fields(**fields):
+    token = _fields.set({**_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        _fields.reset(token)
+
+class FieldsFilter(logging.Filter):
+    def filter(self, record):
+        for field, value in _fields.get().items():
+            setattr(record, field, value)
+        return True
+
+def structured():
+    return environ.get('SCFLOWS_LOG_FORMAT', config._log_format) == 'json'
+
+def logging_formatter():
+    if structured(): return JsonLoggingFormatter()
+    return CutsomLoggingFormatter()
+
 logger = logging.getLogger('scflows')
 logger.setLevel(config._log_level)
+logger.addFilter(FieldsFilter())
 ch = logging.StreamHandler(sys.stdout)
 ch.setLevel(config._log_level)
-ch.setFormatter(CutsomLoggingFormatter())
-logger.addHandler(ch)
+ch.setFormatter(logging_formatter())
+
+if structured():
+    # Records are written to stdout from a separate thread, so that
+    # logging never blocks the tasks on I/O
+    _queue = Queue(-1)
+    qh = FieldsQueueHandler(_queue)
+    listener = QueueListener(_queue, ch, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(qh)
+
+    def _restart_listener():
+        # The listener thread doesn't survive a fork (i.e. celery workers)
+        global _queue, listener
+        _queue = Queue(-1)
+        qh.queue = _queue
+        listener = QueueListener(_queue, ch, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+    register_at_fork(after_in_child=_restart_listener)
+else:
+    logger.addHandler(ch)
 
 def set_logger_level(level=logging.DEBUG):
     logger.setLevel(level)
@@ -1,4 +1,5 @@
 import sys
+import asyncio
 from os.path import join, exists, abspath
 from os import makedirs
 
@@ -10,13 +11,18 @@ if __name__ == '__main__':
     if '-h' in sys.argv or '--help' in sys.argv:
         print('scflow: Process device of SC API')
         print('USAGE:\n\scflow.py [options] action')
-        print('actions: auto-schedule, manual-schedule')
+        print('actions: auto-schedule, manual-schedule, dispatch')
         print('---')
-        print('auto-schedule --celery --interval-days <interval-days> (config._scheduler_interval_days) --task-interval-hours <interval-hours>:')
+        print('auto-schedule --celery --interval-days <interval-days> (config._scheduler_interval_days) --task-interval-hours <interval-hours> [--batch-size <batch-size>]:')
         print('\tSchedule per-devices postproccesing check based on device information available on the platform')
         print('\tauto-schedule makes a global task for checking on <interval-days> interval and then the actual tasks are scheduled based on <task-interval-hours> or default intervals')
+        print('\tWith --batch-size, devices to process are grouped in tasks of <batch-size> devices instead of one task per device')
+        print('\tWith --plan, prints the device tasks that would be added and removed now, without writing anything')
         print('manual-schedule --device <device> --interval-hours <interval-hours> (config._default_task_exec_interval_hours) [--task-file <file>.py] [--celery]:')
         print('\tschedule device processing manually')
+        print('dispatch --workers <workers> (config._dispatcher_workers):')
+        print('\tRun all tasks from a single long-running dispatcher. Only the dispatcher is installed in the crontab')
+        print('\tThe rest of actions keep working on the tabfile. Remove the dispatcher task to go back to one cron line per task')
         print('list-tasks:')
         print('\tList scheduled tasks')
         print('remove-task <task-name>:')
@@ -58,6 +64,24 @@ if __name__ == '__main__':
         else:
             task_interval = None
 
+        if '--batch-size' in sys.argv:
+            batch_size = int(sys.argv[sys.argv.index('--batch-size')+1])
+            task_options.append(f'--batch-size {batch_size}')
+        else:
+            batch_size = None
+
+        if '--plan' in sys.argv:
+            # Heavy imports only needed here
+            from scflows.tasks.dschedule import dschedule
+            plan = asyncio.run(dschedule(interval_hours=task_interval,
+                task=task or 'process',
+                dry_run='--dry-run' in sys.argv,
+                celery='--celery' in sys.argv,
+                batch_size=batch_size,
+                plan_only=True))
+            print(plan)
+            sys.exit()
+
         if '--celery' in sys.argv: task_options.append('--celery')
         if '--dry-run' in sys.argv: task_options.append('--dry-run')
 
@@ -115,6 +139,26 @@ if __name__ == '__main__':
                         overwrite = overwrite)
         sys.exit()
 
+    if 'dispatch' in sys.argv:
+        script = f'{config._dispatcher}.py'
+        task_options = []
+
+        if '--workers' in sys.argv:
+            workers = int(sys.argv[sys.argv.index('--workers')+1])
+            task_options.append(f'--workers {workers}')
+
+        t = Task(script=script, options=task_options)
+
+        log = abspath(join(config.paths['log']))
+        makedirs(log, exist_ok=True)
+
+        # Cron relaunches it every minute in case it died, it exits if already running
+        s.schedule_task(task=t,
+                        log=join(log, config._dispatcher_log),
+                        interval='1M',
+                        overwrite=overwrite)
+        sys.exit()
+
     if 'list-tasks' in sys.argv:
         s.list_tasks()
 
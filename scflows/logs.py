@@ -0,0 +1,247 @@
+from os.path import getsize, join, dirname, basename, exists
+from os import fstat, readlink, replace, remove
+from datetime import datetime, timedelta
+from stat import S_ISREG
+from time import sleep, monotonic
+from io import BytesIO
+import shutil
+import fcntl
+import gzip
+import json
+import sys
+import re
+
+from markupsafe import escape
+
+from scflows.config import config
+
+# ANSI colour codes from the custom_logger formatter
+ANSI = re.compile(r'\x1b\[([\d;]*)m')
+COLOURS = {
+    '31': '<span style="color:#B22222">',
+    '33': '<span style="color:rgb(255,200,0)">',
+    '32': '<span style="color:#228B22">'
+}
+
+def ansi_to_html(line):
+    '''
+        Escapes a log line and converts its ANSI colours
+        to html in a single pass
+    '''
+    opened = 0
+
+    def colour(match):
+        nonlocal opened
+        code = match.group(1).split(';')[0]
+        if code in COLOURS:
+            opened += 1
+            return COLOURS[code]
+        if code in ['0', ''] and opened:
+            opened -= 1
+            return '</span>'
+        return ''
+
+    html = ANSI.sub(colour, str(escape(line)))
+    return html + '</span>' * opened
+
+# Colour of each level in structured (JSON) logs
+LEVELS = {
+    'WARNING': COLOURS['33'],
+    'ERROR': COLOURS['31'],
+    'CRITICAL': COLOURS['31']
+}
+
+def json_to_html(entry):
+    fields = ' '.join(f'{field}={entry[field]}' for field in ['device', 'task', 'stage'] if field in entry)
+    text = f"[{entry.get('time')}] - {entry.get('name')} - {entry.get('level')} - {entry.get('message')}"
+    if fields: text += f' ({fields})'
+    if 'exception' in entry: text += f"\n{entry['exception']}"
+    html = str(escape(text))
+    if entry.get('level') in LEVELS: return f"{LEVELS[entry['level']]}{html}</span>"
+    return html
+
+def render_line(line):
+    '''
+        Html of a log line, either structured (JSON) or text with colours
+    '''
+    if line.startswith('{'):
+        try:
+            return json_to_html(json.loads(line))
+        except ValueError:
+            pass
+    return ansi_to_html(line)
+
+def read_page(path, before = None, size = None, archive = None):
+    '''
+        Reads the lines in the last size bytes of a log (or of one of its
+        archives) ending at the offset before (end of file by default),
+        seeking instead of reading the whole file. Returns the lines, and
+        the offsets where they start and end
+    '''
+    if size is None: size = config._log_page_bytes
+
+    if archive is None:
+        opened = open(path, 'rb')
+    else:
+        # Archives are bounded by config._log_max_bytes
+        with gzip.open(join(dirname(path), archive['file']), 'rb') as file:
+            opened = BytesIO(file.read())
+
+    with opened as file:
+        file.seek(0, 2)
+        end = file.tell() if before is None else min(before, file.tell())
+        start = max(0, end - size)
+        file.seek(start)
+        chunk = file.read(end - start)
+
+    # Drop the first line if it's cut
+    if start > 0:
+        cut = chunk.find(b'\n') + 1
+        if cut == 0: cut = len(chunk)
+        chunk = chunk[cut:]
+        start += cut
+
+    lines = [render_line(line) for line in chunk.decode('utf-8', errors='replace').splitlines() if line]
+    return lines, start, end
+
+def tail(path, offset, running):
+    '''
+        Server-sent events with the lines appended to a log after offset,
+        while running() is True. Each stream lasts at most config._log_tail_seconds
+        and the browser reconnects from the last event id (the offset)
+    '''
+    yield f'retry: {config._log_tail_retry_ms}\n\n'
+
+    deadline = monotonic() + config._log_tail_seconds
+    pending = b''
+
+    while monotonic() < deadline:
+        # Don't miss the last lines once it's done
+        done = not running()
+
+        size = getsize(path)
+        # Truncated or rotated
+        if size < offset: offset = 0
+        if size > offset:
+            with open(path, 'rb') as file:
+                file.seek(offset)
+                data = file.read(size - offset)
+            offset = size
+            # Only complete lines
+            *lines, pending = (pending + data).split(b'\n')
+            for line in lines:
+                if not line: continue
+                yield f"id: {offset - len(pending)}\ndata: {render_line(line.decode('utf-8', errors='replace'))}\n\n"
+
+        if done:
+            yield 'event: done\ndata: \n\n'
+            return
+
+        sleep(config._log_tail_poll_seconds)
+
+    # Keep the connection alive until the browser reconnects
+    yield ': reconnect\n\n'
+
+# Timestamp of the custom_logger formats: [2024-01-01 00:00:00,000]
+# in text logs, {"time": "2024-01-01 00:00:00,000", ...} in JSON logs
+TIMESTAMP = re.compile(rb'(?:\[|"time": ")(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+
+def archives(path):
+    '''
+        Index of the archives of a log: file, start and end time, and bytes
+    '''
+    try:
+        with open(f'{path}.archives.json') as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def find_archive(path, at):
+    '''
+        Archive of a log containing the datetime at, None if it's
+        in the current log
+    '''
+    for archive in archives(path):
+        if archive['start'] is not None and datetime.fromisoformat(archive['start']) > at: continue
+        if datetime.fromisoformat(archive['end']) >= at: return archive
+    return None
+
+def rotate(path, max_bytes = None, days = None):
+    '''
+        Compresses a log into an archive and truncates it in place when it is
+        over max_bytes, or started more than days ago. Truncating instead of
+        renaming lets writers that have it open in append mode (>> log)
+        carry on. Returns the archive, if any
+    '''
+    if max_bytes is None: max_bytes = config._log_max_bytes
+    if days is None: days = config._log_rotation_days
+    if not exists(path): return None
+
+    with open(path, 'rb+') as file:
+        # Someone else is rotating it
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+
+        size = fstat(file.fileno()).st_size
+        if not size: return None
+
+        index = archives(path)
+        if index:
+            start = datetime.fromisoformat(index[-1]['end'])
+        else:
+            match = TIMESTAMP.search(file.read(4096))
+            start = datetime.strptime(match.group(1).decode(), '%Y-%m-%d %H:%M:%S') if match else None
+        now = datetime.now()
+
+        if size < max_bytes and (start is None or now - start < timedelta(days=days)):
+            return None
+
+        archive = {
+            'file': f"{basename(path)}.{now.strftime('%Y%m%d-%H%M%S-%f')}.gz",
+            'start': start.isoformat() if start is not None else None,
+            'end': now.isoformat(),
+            'bytes': size
+        }
+
+        file.seek(0)
+        with gzip.open(join(dirname(path), archive['file']), 'wb', compresslevel=config._log_compression_level) as out:
+            shutil.copyfileobj(file, out)
+        file.truncate(0)
+
+        index.append(archive)
+        # Drop the oldest archives
+        for old in index[:-config._log_archives]:
+            try:
+                remove(join(dirname(path), old['file']))
+            except FileNotFoundError:
+                pass
+        index = index[-config._log_archives:]
+
+        with open(f'{path}.archives.json.tmp', 'w') as out:
+            json.dump(index, out)
+        replace(f'{path}.archives.json.tmp', f'{path}.archives.json')
+
+    return archive
+
+def output_log(stream = None):
+    '''
+        Path of the log a stream is redirected to (i.e. >> log 2>&1 in
+        the crontab), or None if it isn't a file
+    '''
+    if stream is None: stream = sys.stdout
+    try:
+        fd = stream.fileno()
+        if not S_ISREG(fstat(fd).st_mode): return None
+        return readlink(f'/proc/self/fd/{fd}')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def rotate_output():
+    '''
+        Rotates the log of the running task, if needed
+    '''
+    path = output_log()
+    if path is not None:
+        rotate(path)
@@ -1,16 +1,20 @@
 #!/usr/bin/python
 
-from flask import Flask, request, render_template, redirect, url_for, Blueprint
+from flask import Flask, request, render_template, redirect, url_for, Blueprint, Response, stream_with_context, jsonify, abort
 from flask_login import login_required, current_user
 
 import json
+from datetime import datetime
 from os.path import join, exists
 from os import getcwd
 from os import environ
 
 from scflows.config import config
-from scflows.cron import parsetabfiles, validate, savetabfiles, triggercrontab
+from scflows.cron import tabcache, validate, savetabfiles, triggercrontab
 from scflows.tools import get_tabfile_dir
+from scflows.tasks.metrics import Metrics
+from scflows.tasks.history import query_history
+from scflows.logs import read_page, tail, archives, find_archive
 
 tabfile_dir=None
 cronthread={}
@@ -22,6 +26,22 @@ main = Blueprint('main', __name__)
 def index():
     return render_template('index.html')
 
+@main.route('/metrics')
+def metrics():
+    # Written by the tasks, in prometheus text format
+    m = Metrics()
+    text = m.render()
+    m.close()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@main.route('/history/<query>')
+@login_required
+def history(query):
+    # slowest, failures or backlog over the last days
+    result = query_history(query, days=request.args.get('days', type=int), limit=request.args.get('limit', 20, type=int))
+    if result is None: abort(404)
+    return jsonify(result)
+
 @main.route('/tasks', methods = ['GET', 'POST'])
 @login_required
 def default():
@@ -40,14 +60,15 @@ def default():
                 prepend = getcwd()
             tabfile_dir=join(prepend, config.paths['tabs'])
     global tabfiles
-    tabfiles = parsetabfiles(path=tabfile_dir)
+    tabfiles = tabcache.parse(tabfile_dir)
     return render_template("jobs.html", tabfiles=tabfiles, defaultpath=tabfile_dir, error=error)
 
 @main.route('/editjob/<tabfile>-<cron>', methods = ['POST', 'GET'])
 @login_required
 def editjob(tabfile,cron,error=None):
     global tabfiles
-    tabfiles = parsetabfiles(path=tabfile_dir)
+    # Edit a copy, the cached record only changes with the tabfile
+    crondict = dict(tabcache.job(tabfile_dir, tabfile, cron))
     if request.method == 'POST':
         request.get_data()
         # Form input
@@ -59,18 +80,19 @@ def editjob(tabfile,cron,error=None):
         who=request.form["who-input"]
         # Validate
         error=validate(schedule, who, task, log)
-        tabfiles[tabfile][cron]['logfile']=log
-        tabfiles[tabfile][cron]['task']=task
-        tabfiles[tabfile][cron]['schedule']=schedule
-        tabfiles[tabfile][cron]['enabled']=enabled
-        tabfiles[tabfile][cron]['who']=who
+        crondict['logfile']=log
+        crondict['task']=task
+        crondict['schedule']=schedule
+        crondict['enabled']=enabled
+        crondict['who']=who
         # Check error
         if not error:
+            tabfiles = dict(tabcache.parse(tabfile_dir))
+            tabfiles[tabfile] = {**tabfiles[tabfile], cron: crondict}
             savetabfiles(tabfiles=tabfiles, path=tabfile_dir)
             return redirect(url_for("main.default"))
     # Overwrite schedule to cope with lists or normal strings options
-    tabfiles[tabfile][cron]['schedule'] = str(tabfiles[tabfile][cron]['schedule'])
-    crondict=tabfiles[tabfile][cron]
+    crondict['schedule'] = str(crondict['schedule'])
 
     return render_template("editjob.html", tabfile=tabfile, cron=cron, crondict=crondict, error=error)
 
@@ -78,11 +100,11 @@ def editjob(tabfile,cron,error=None):
 @login_required
 def triggerjob(tabfile, cron):
     global cronthread
-    tabfiles=parsetabfiles(path=tabfile_dir)
     if request.method == 'POST':
         cronthread[cron] = triggercrontab(tabfile_dir,tabfile,cron)
         if cronthread[cron] == False:
             error = "Job could not run as it's not valid"
+            tabfiles = tabcache.parse(tabfile_dir)
             return render_template("jobs.html", tabfiles=tabfiles, defaultpath=tabfile_dir, error=error)
         else:
             return redirect(url_for("main.logfile", tabfile=tabfile, cron=cron))
@@ -90,7 +112,6 @@ def triggerjob(tabfile, cron):
 @main.route('/tabfiles/<tabfile>')
 @login_required
 def tabfile(tabfile):
-    tabfiles = parsetabfiles(path=tabfile_dir)
     tabpath = f"{tabfile_dir}/{tabfile}.tab"
     tab = []
     with open(tabpath, 'r') as file:
@@ -106,41 +127,48 @@ def tabfile(tabfile):
 def logfile(tabfile, cron):
     print (tabfile)
     global cronthread
-    global tabfiles
-    tabfiles = parsetabfiles(path=tabfile_dir)
-    print (tabfiles)
-    logfile = tabfiles[tabfile][cron]['logfile']
-    log = []
-    with open(logfile, 'r') as file:
-        _log = file.readlines()
-    for line in _log:
-        line = line.strip('\n')
-        if line != '':
-            if '[31m' in line:
-                line = line.replace('\x1b[31m', '<span style="color:#B22222">')
-                line = line.replace('\x1b[0m', '</span>')
-            if '[33m' in line:
-                line = line.replace('\x1b[33m', '<span style="color:rgb(255,200,0)">')
-                line = line.replace('\x1b[0m', '</span>')
-            if '[32m' in line:
-                line = line.replace('\x1b[32m', '<span style="color:#228B22">')
-                line = line.replace('\x1b[0m', '</span>')
-            log.append(line)
+    logfile = tabcache.job(tabfile_dir, tabfile, cron)['logfile']
+    # Archived segment, by name or containing a time
+    _archives = archives(logfile)
+    archive = next((item for item in _archives if item['file'] == request.args.get('archive')), None)
+    if 'at' in request.args:
+        try:
+            at = datetime.fromisoformat(request.args['at'])
+        except ValueError:
+            abort(400)
+        # Archives are in local time
+        if at.tzinfo is not None: at = at.astimezone().replace(tzinfo=None)
+        archive = find_archive(logfile, at)
+    # Only the last page, or the one ending at before
+    before = request.args.get('before', type=int)
+    log, start, end = read_page(logfile, before=before, archive=archive)
     if cron in cronthread:
         status = cronthread[cron].status
     else:
         status = 'Not running'
-    return render_template("file_viewer.html", file_type='log', cron=cron, file=log, status = status)
+    return render_template("file_viewer.html", file_type='log', tabfile=tabfile, cron=cron, file=log, status = status,
+        start=start, end=end, latest=before is None and archive is None, archive=archive, archives=_archives)
+
+@main.route('/logfiles/<tabfile>-<cron>/tail')
+@login_required
+def logtail(tabfile, cron):
+    logfile = tabcache.job(tabfile_dir, tabfile, cron)['logfile']
+    # Resume from the last line sent when the browser reconnects
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None: offset = request.args.get('offset', 0, type=int)
+
+    def running():
+        return cron in cronthread and cronthread[cron].status != 'done'
+
+    return Response(stream_with_context(tail(logfile, offset, running)), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @main.route('/jobfiles/<tabfile>-<cron>')
 @login_required
 def taskfile(tabfile, cron):
     print (tabfile)
-    global tabfiles
-    tabfiles = parsetabfiles(path=tabfile_dir)
     print (tabfile_dir)
-    print (tabfiles)
-    taskfile = tabfiles[tabfile][cron]['task'].split(' ')[0]
+    taskfile = tabcache.job(tabfile_dir, tabfile, cron)['task'].split(' ')[0]
     task = []
     with open(taskfile, 'r') as file:
         _task = file.readlines()
@@ -3,4 +3,17 @@
 # from .handlers import Message, MappingHandler, MessageHandler, SchemaHandler
 # from .dforward import mqtt_forward
 # from .staplus import staplus_mqtt_forward
-from .scheduler import Scheduler, Task
\ No newline at end of file
+
+# Imported on first use, so that the task scripts don't pay for them
+_modules = {
+    'Scheduler': 'scheduler',
+    'Task': 'scheduler',
+    'Plan': 'scheduler',
+    'Dispatcher': 'dispatcher'
+}
+
+def __getattr__(name):
+    if name in _modules:
+        from importlib import import_module
+        return getattr(import_module(f'.{_modules[name]}', __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
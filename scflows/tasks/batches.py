@@ -0,0 +1,45 @@
+from os.path import join
+from os import replace
+import json
+
+from scflows.config import config
+
+def batches_path():
+    return join(config.paths['tabs'], config._batches)
+
+def read_batches(path = None):
+    '''
+        Devices of each batch task, by batch index
+    '''
+    if path is None: path = batches_path()
+    try:
+        with open(path) as file:
+            return {int(index): devices for index, devices in json.load(file).items()}
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write_batches(batches, path = None):
+    if path is None: path = batches_path()
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump({str(index): devices for index, devices in sorted(batches.items())}, file)
+    replace(f'{path}.tmp', path)
+
+def batch_devices(index, path = None):
+    return read_batches(path).get(index, [])
+
+def assign_batches(batches, devices, batch_size):
+    '''
+        Stable batches: devices stay in their batch, the ones no longer there
+        leave it, and new ones fill the batches with room, lowest index first.
+        Batches left empty are dropped
+    '''
+    wanted = set(devices)
+    assigned = {index: [device for device in members if device in wanted] for index, members in batches.items()}
+    placed = set(device for members in assigned.values() for device in members)
+
+    index = 0
+    for device in sorted(wanted - placed):
+        while len(assigned.get(index, [])) >= batch_size: index += 1
+        assigned.setdefault(index, []).append(device)
+
+    return {index: sorted(members) for index, members in assigned.items() if members}
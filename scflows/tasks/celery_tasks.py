@@ -0,0 +1,61 @@
+import asyncio
+
+from scflows.worker import app
+from scflows.custom_logger import logger
+from scflows.tasks.dprocess import dprocess, dprocess_batch
+from scflows.tasks.dbackup import dbackup
+from scflows.tasks.history import flush_runs
+from celery.exceptions import Ignore
+
+# The celery tasks live apart from the task scripts, so that running
+# these doesn't need to import celery or build the app
+
+@app.task(bind=True,track_started=True, name='scflows.tasks.dprocess_task')
+def dprocess_task(self, device, dry_run=False, catchup=False, budget=None):
+    result, state, stages = asyncio.run(dprocess(device, dry_run, catchup, budget))
+    flush_runs()
+    logger.info('dprocess')
+    logger.info(result)
+    logger.info(state)
+
+    # Raise custom state
+    if state[0] != 'SUCCESS':
+
+        self.update_state(
+            state=state[0],
+            meta={'message': state[1], 'stages': stages})
+        with self.app.events.default_dispatcher() as dispatcher:
+            dispatcher.send('task-custom_state', field1='value1', field2='value2')
+
+        raise Ignore()
+    return {'task_log': result, 'task_stages': stages}
+
+@app.task(bind=True,track_started=True, name='scflows.tasks.dprocess_batch_task')
+def dprocess_batch_task(self, devices, dry_run=False, concurrency=None, catchup=False, budget=None):
+    results = asyncio.run(dprocess_batch(devices, dry_run, concurrency, catchup, budget))
+    flush_runs()
+    logger.info('dprocess_batch')
+    for result in results:
+        logger.info(f"{result['device']}: {result['task_state']}")
+
+    return results
+
+@app.task(bind=True, track_started=True, name='scflows.tasks.dbackup_task')
+def dbackup_task(self, device, catchup=False, concurrency=None, budget=None):
+    result, state, stages = asyncio.run(dbackup(device, catchup, concurrency, budget))
+    flush_runs()
+    logger.info('dbackup')
+    logger.info(result)
+    logger.info(state)
+
+    # Raise custom state
+    if state[0] != 'SUCCESS':
+
+        self.update_state(
+            state=state[0],
+            meta={'message': state[1], 'stages': stages})
+        with self.app.events.default_dispatcher() as dispatcher:
+            dispatcher.send('task-custom_state', field1='value1', field2='value2')
+
+        raise Ignore()
+    return {'task_log': result, 'task_stages': stages}
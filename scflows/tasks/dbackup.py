@@ -1,26 +1,40 @@
-import scdata as sc
-
 import sys
+import time
 import asyncio
+from os.path import basename
 import os
 import json
-import boto3
-import awswrangler as wr
 import datetime
-import botocore
 
-from scflows.worker import app
 from scflows.config import config
-from scflows.custom_logger import logger
-from celery.result import AsyncResult
-from celery.exceptions import Ignore
-from celery import states
-
-async def dbackup(device):
+from scflows.custom_logger import logger, set_log_fields
+from scflows.tools import LazyCallable
+from scflows.tasks.durations import record_duration
+from scflows.tasks.stages import Stages
+from scflows.tasks.metrics import record_task
+from scflows.tasks.preflight import nothing_to_backup
+from scflows.logs import rotate_output
+
+# Heavy dependencies are only imported when the task is run
+Device = LazyCallable('scdata.Device')
+APIParams = LazyCallable('scdata.APIParams')
+record_run = LazyCallable('scflows.tasks.history.record_run')
+load_readings = LazyCallable('scflows.tasks.readings.load_readings')
+
+async def dbackup(device, catchup = False, concurrency = None, budget = None):
     '''
-        This function makes a backup of a device from SC API into a S3 bucket for later recovery
+        This function makes a backup of a device from SC API into a S3 bucket for later recovery.
+        In catchup mode, it backs up all the complete periods since the last one, `concurrency`
+        at a time, until the time budget (seconds) is over.
+        Returns the task log, state and the timing of each stage
     '''
+    if concurrency is None:
+        concurrency = config._backup_catchup_concurrency
+    if budget is None:
+        budget = config._backup_catchup_budget_seconds
+
     task_log = []
+    task_stages = Stages()
 
     def logger_handler(msg, level='info'):
         if level == 'info':
@@ -31,64 +45,227 @@ async def dbackup(device):
             logger.error(msg)
         return f'{level}: {msg}'
 
+    # Records of this device (its own asyncio task) carry these fields
+    set_log_fields(device=device, task='backup')
+
     logger_handler(f'Backup instance for device {device}')
 
+    import boto3
+    import botocore
+
+    def conclude(task_state):
+        task_log.append(logger_handler(f'Stages: {task_stages}'))
+        task_log.append(logger_handler(f'Concluded job for {device}'))
+
+        summary = task_stages.summary()
+        record_task('backup', task_state, summary)
+        record_run(device, 'backup', task_state, summary)
+
+        return task_log, task_state, summary
+
+    async def catch_up(d, mode):
+        '''
+            Backs up the periods of config._backup_interval_days between the last
+            requested data and the last reading. Periods are loaded concurrently
+            and backed up in order, moving the last requested data with each one.
+            No period is backed up after one that failed
+        '''
+        interval = datetime.timedelta(days=config._backup_interval_days)
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        last_reading_at = d.handler.json.last_reading_at
+
+        windows = []
+        start = last_requested_data or d.handler.json.created_at
+        # Only complete periods, as in a single backup
+        while start < last_reading_at and start + interval <= now:
+            windows.append((start, min(start + interval, last_reading_at)))
+            start += interval
+
+        if not windows:
+            task_log.append(logger_handler(f'Device {device} has no new data. Nothing to do', 'warning'))
+            return ['ABORTED', 'NO_NEW_DATA']
+
+        task_log.append(logger_handler(f'Catching up {len(windows)} periods from {windows[0][0]} to {windows[-1][1]}'))
+
+        semaphore = asyncio.Semaphore(concurrency)
+        # Periods are loaded concurrently, but backed up in order
+        turn = asyncio.Condition()
+        progress = {'cursor': 0, 'stop': len(windows), 'rows': 0, 'bytes': 0}
+        started = time.perf_counter()
+
+        async def backup_window(index, mode):
+            '''
+                Loads a period and, once the previous ones are backed up,
+                backs it up and moves the last requested data. Returns
+                whether it was backed up
+            '''
+            if time.perf_counter() - started > budget: return False
+
+            min_date, max_date = windows[index]
+            # Each period loads into its own device
+            if index == 0: w = d
+            else: w = await asyncio.to_thread(Device, blueprint='sc_air', params=APIParams(id=device))
+            w.options.min_date = min_date
+            w.options.max_date = max_date
+
+            with task_stages.stage('load') as stage:
+                loaded = await load_readings(w, stage)
+                stage['rows'] = len(w.data.index)
+                stage['channels'] = len(w.data.columns)
+
+            if not loaded and not w.data.empty:
+                task_log.append(logger_handler(f'Period from {min_date} to {max_date} was not loaded', 'warning'))
+                return False
+
+            async with turn:
+                # Appending past a failed period would be appended again by the next run
+                await turn.wait_for(lambda: progress['cursor'] == index or progress['stop'] <= index)
+                if progress['stop'] <= index: return False
+
+                # Periods without readings are backed up as they are
+                if loaded:
+                    with task_stages.stage('backup') as stage:
+                        stage['bytes'] = int(w.data.memory_usage(deep=True).sum())
+                        backed_up = await asyncio.to_thread(w.backup, mode=mode)
+                    if not backed_up:
+                        task_log.append(logger_handler(f'Period from {min_date} to {max_date} was not backed-up', 'warning'))
+                        return False
+                    progress['rows'] += len(w.data.index)
+                    progress['bytes'] += stage['bytes']
+
+                with task_stages.stage('request_put'):
+                    s3object = s3.Object(f"{os.environ['S3_DATA_BUCKET']}", f"devices/{device}/request.json")
+                    await asyncio.to_thread(s3object.put,
+                        Body=(bytes(json.dumps({"last_requested_data": max_date.isoformat()}).encode('UTF-8')))
+                    )
+                progress['cursor'] = index + 1
+                turn.notify_all()
+            return True
+
+        async def window(index, mode):
+            async with semaphore:
+                backed_up = False
+                try:
+                    backed_up = await backup_window(index, mode)
+                finally:
+                    # Later periods are not backed up either
+                    if not backed_up:
+                        async with turn:
+                            progress['stop'] = min(progress['stop'], index)
+                            turn.notify_all()
+
+        with task_stages.stage('catchup') as stage:
+            # The first backup creates the dataset, the rest append to it
+            if mode == 'overwrite':
+                await window(0, mode)
+                if progress['cursor'] == 1:
+                    await asyncio.gather(*[window(index, 'append') for index in range(1, len(windows))])
+            else:
+                await asyncio.gather(*[window(index, mode) for index in range(len(windows))])
+
+            seconds = max(time.perf_counter() - started, 1e-9)
+            stage['windows'] = progress['cursor']
+            stage['rows'] = progress['rows']
+            stage['bytes'] = progress['bytes']
+            stage['rows_per_second'] = round(progress['rows'] / seconds, 1)
+            stage['bytes_per_second'] = round(progress['bytes'] / seconds, 1)
+
+        task_log.append(logger_handler(f"Backed up {progress['cursor']} of {len(windows)} periods, "
+            f"{stage['rows_per_second']} rows/s, {stage['bytes_per_second']} bytes/s"))
+
+        if progress['cursor'] == len(windows):
+            return ['SUCCESS', 'BACKUP_DONE']
+        elif progress['cursor'] > 0:
+            task_log.append(logger_handler(f'Backed up until {windows[progress["cursor"]-1][1]}, continues in the next run', 'warning'))
+            return ['SUCCESS', 'BACKUP_PARTIAL']
+        return ['ABORTED', 'BACKUP_FAILED']
+
+    # Last data requested by a previous backup, before creating the device
+    last_requested_data = None
+    try:
+        with task_stages.stage('request_get'):
+            s3 = boto3.resource('s3')
+            metadata = s3.Object(f"{os.environ['S3_DATA_BUCKET']}", f"devices/{device}/request.json").get()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == "NoSuchKey":
+            # The object does not exist.
+            task_log.append(logger_handler('No last date available'))
+            mode = 'overwrite'
+        else:
+            # Something else has gone wrong.
+            task_log.append(logger_handler(e.response, 'error'))
+            return conclude(['ABORTED', 'REQUEST_FAILED'])
+    else:
+        # The object does exist.
+        task_log.append(logger_handler('Already requested data...'))
+        response = json.loads(metadata['Body'].read().decode('utf-8'))
+        last_requested_data = datetime.datetime.fromisoformat(response['last_requested_data'])
+        task_log.append(logger_handler(f'Last requested date: {last_requested_data}'))
+        mode = 'append'
+
+    # Nothing new since the last backup, or period not complete yet
+    if config._preflight:
+        with task_stages.stage('preflight'):
+            idle = await asyncio.to_thread(nothing_to_backup, device, last_requested_data)
+
+        if idle:
+            task_log.append(logger_handler(f'Device {device} has no new data. Nothing to do', 'warning'))
+            return conclude(['ABORTED', 'NO_NEW_DATA'])
+
     # Create device from SC API
-    d = sc.Device(blueprint='sc_air', params=sc.APIParams(id=device))
-    s3 = boto3.resource('s3')
+    with task_stages.stage('init'):
+        d = Device(blueprint='sc_air', params=APIParams(id=device))
     task_state = [None, None]
 
     if d:
         task_log.append(logger_handler(f'Device {device} Initialized'))
-        skip = False
 
-        try:
-            metadata = s3.Object(f"{os.environ['S3_DATA_BUCKET']}", f"devices/{d.id}/request.json").get()
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "NoSuchKey":
-                # The object does not exist.
-                task_log.append(logger_handler('No last date available'))
-                d.options.max_date = d.handler.json.created_at + datetime.timedelta(days=config._backup_interval_days)
-                mode = 'overwrite'
-            else:
-                # Something else has gone wrong.
-                logger_handler(e.response)
-        else:
-            # The object does exist.
-            task_log.append(logger_handler('Already requested data...'))
-            response = json.loads(metadata['Body'].read().decode('utf-8'))
-            last_requested_data = datetime.datetime.fromisoformat(response['last_requested_data'])
-            task_log.append(logger_handler(f'Last requested date: {last_requested_data}'))
-            mode = 'append'
+        if catchup:
+            return conclude(await catch_up(d, mode))
 
-            if last_requested_data < d.handler.json.last_reading_at:
+        skip = False
 
-                d.options.min_date = last_requested_data
-                d.options.max_date = last_requested_data + datetime.timedelta(days=config._backup_interval_days)
+        if last_requested_data is None:
+            d.options.max_date = d.handler.json.created_at + datetime.timedelta(days=config._backup_interval_days)
+        elif last_requested_data < d.handler.json.last_reading_at:
 
-                if d.options.max_date > datetime.datetime.now(tz=datetime.timezone.utc):
-                    task_log.append(logger_handler(f'Best to wait until period is complete, skip'))
-                    skip = True
-                elif d.options.max_date > d.handler.json.last_reading_at:
-                    d.options.max_date = d.handler.json.last_reading_at
+            d.options.min_date = last_requested_data
+            d.options.max_date = last_requested_data + datetime.timedelta(days=config._backup_interval_days)
 
-            else:
+            if d.options.max_date > datetime.datetime.now(tz=datetime.timezone.utc):
+                task_log.append(logger_handler(f'Best to wait until period is complete, skip'))
                 skip = True
+            elif d.options.max_date > d.handler.json.last_reading_at:
+                d.options.max_date = d.handler.json.last_reading_at
+
+        else:
+            skip = True
 
         if not skip:
             task_log.append(logger_handler(f'Min date: {d.options.min_date}'))
             task_log.append(logger_handler(f'Max date: {d.options.max_date}'))
 
-            if await d.load():
+            with task_stages.stage('load') as stage:
+                loaded = await load_readings(d, stage)
+                stage['rows'] = len(d.data.index)
+                stage['channels'] = len(d.data.columns)
+
+            if loaded:
                 task_log.append(logger_handler(f'Device was loaded: {d.loaded}'))
 
                 # Back it up it
-                if d.backup(mode=mode):
-
-                    s3object = s3.Object(f"{os.environ['S3_DATA_BUCKET']}", f"devices/{d.id}/request.json")
-                    s3object.put(
-                        Body=(bytes(json.dumps({"last_requested_data": d.options.max_date.isoformat()}).encode('UTF-8')))
-                    )
+                with task_stages.stage('backup') as stage:
+                    # In-memory size of the backed-up data
+                    stage['bytes'] = int(d.data.memory_usage(deep=True).sum())
+                    backed_up = d.backup(mode=mode)
+
+                if backed_up:
+
+                    with task_stages.stage('request_put'):
+                        s3object = s3.Object(f"{os.environ['S3_DATA_BUCKET']}", f"devices/{d.id}/request.json")
+                        s3object.put(
+                            Body=(bytes(json.dumps({"last_requested_data": d.options.max_date.isoformat()}).encode('UTF-8')))
+                        )
                     task_state = ['SUCCESS', 'BACKUP_DONE']
                     task_log.append(logger_handler(f'Device was backed-up'))
                 else:
@@ -107,28 +284,14 @@ async def dbackup(device):
         task_log.append(logger_handler(f'Device {device} not valid', 'error'))
         task_state = ['ABORTED', 'DEVICE_NOT_VALID']
 
-    task_log.append(logger_handler(f'Concluded job for {device}'))
-
-    return task_log, task_state
-
-@app.task(bind=True, track_started=True, name='scflows.tasks.dbackup_task')
-def dbackup_task(self, device):
-    result, state = asyncio.run(dbackup(device))
-    logger.info('dbackup')
-    logger.info(result)
-    logger.info(state)
-
-    # Raise custom state
-    if state[0] != 'SUCCESS':
+    return conclude(task_state)
 
-        self.update_state(
-            state=state[0],
-            meta={'message': state[1]})
-        with self.app.events.default_dispatcher() as dispatcher:
-            dispatcher.send('task-custom_state', field1='value1', field2='value2')
-
-        raise Ignore()
-    return result
+def __getattr__(name):
+    # The celery task moved to celery_tasks
+    if name == 'dbackup_task':
+        from scflows.tasks import celery_tasks
+        return celery_tasks.dbackup_task
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 if __name__ == '__main__':
 
@@ -137,11 +300,20 @@ if __name__ == '__main__':
         print('USAGE:\n\rdbackup.py [options]')
         print('options:')
         print('--device <device-number>: device to backup')
+        print('--catchup: backup all complete periods since the last backup')
+        print('--concurrency <concurrency>: periods backed up at the same time in catchup mode (default: config._backup_catchup_concurrency)')
+        print('--budget <seconds>: time budget in catchup mode (default: config._backup_catchup_budget_seconds)')
         # TODO Add custom storage
         # print('--dest <type>: backup destination')
         print('--celery: task execution is managed via celery worker')
         sys.exit()
 
+    # Archive the log of this task if it's too big or old
+    rotate_output()
+
+    from scflows.tasks.scheduler import Task
+
+    start = time.perf_counter()
     loop = asyncio.get_event_loop()
 
     if '--device' in sys.argv:
@@ -150,23 +322,37 @@ if __name__ == '__main__':
         logger.error('Missing device')
         sys.exit()
 
+    catchup = '--catchup' in sys.argv
+    if '--concurrency' in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index('--concurrency')+1])
+    else:
+        concurrency = None
+    if '--budget' in sys.argv:
+        budget = float(sys.argv[sys.argv.index('--budget')+1])
+    else:
+        budget = None
+
     logger.info(f'Backing up device: {device}')
 
     if '--celery' in sys.argv:
         logger.info(f'Using celery backend...')
-        task_id = dbackup_task.s().delay(device = device)
+        from scflows.worker import app
+        from scflows.tasks.celery_tasks import dbackup_task
+        from celery.result import AsyncResult
+        task_id = dbackup_task.s().delay(device = device, catchup = catchup, concurrency = concurrency, budget = budget)
         logger.info(f'Task ID: {task_id}')
 
         # Wait for result
         result = AsyncResult(task_id, app=app)
-        result.wait(timeout=60)
+        result.wait(timeout=60 + (budget or config._backup_catchup_budget_seconds if catchup else 0))
 
         logger.info('Task result:')
-        for res in result.get():
+        for res in result.get()['task_log']:
             logger.info(res)
+        logger.info(result.get()['task_stages'])
     else:
-        loop.run_until_complete(dbackup(device))
+        loop.run_until_complete(dbackup(device, catchup, concurrency, budget))
 
+    # Measured duration, for load balancing
+    record_duration(Task(script=basename(__file__), options=sys.argv[1:]).name, time.perf_counter() - start)
     loop.close()
-
-
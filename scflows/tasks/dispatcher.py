@@ -0,0 +1,269 @@
+from crontab import CronTab
+from os.path import join, basename, getmtime, exists
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from contextvars import ContextVar
+from time import sleep, perf_counter
+import subprocess
+import asyncio
+import logging
+import fcntl
+import sys
+
+from scflows.config import config
+from scflows.custom_logger import logger, logging_formatter
+from scflows.tools import LazyCallable
+from scflows.tasks.durations import record_duration
+from scflows.tasks.history import flush_runs
+from scflows.tasks.batches import batch_devices
+from scflows.logs import rotate_output, rotate
+
+# Heavy task modules are only imported on first use
+_runners = {
+    f'{config._device_processor}.py': LazyCallable('scflows.tasks.dprocess.dprocess'),
+    f'{config._device_storer}.py': LazyCallable('scflows.tasks.dbackup.dbackup')
+}
+
+_batch_runner = LazyCallable('scflows.tasks.dprocess.dprocess_batch')
+
+# Task run in process in the current context, also in its asyncio tasks and threads
+_running = ContextVar('dispatch_entry', default=None)
+
+def next_run(job, after):
+    '''
+        Returns the next datetime after `after` in which the job is due,
+        or None if it never runs (i.e. @reboot)
+    '''
+    if job.special == '@reboot': return None
+
+    minutes, hours, doms, months, dows = [sorted(s) for s in job.slices]
+    # Cron semantics: if both day fields are restricted, either can match
+    any_day = len(doms) < 31 and len(dows) < 7
+
+    start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    for days in range(366):
+        day = start.date() + timedelta(days=days)
+        if day.month not in months: continue
+        dom_ok = day.day in doms
+        dow_ok = day.isoweekday() % 7 in dows
+        if not ((dom_ok or dow_ok) if any_day else (dom_ok and dow_ok)): continue
+
+        for hour in hours:
+            for minute in minutes:
+                candidate = datetime(day.year, day.month, day.day, hour, minute)
+                if candidate >= start: return candidate
+
+    return None
+
+class DispatchEntry(object):
+    """Task parsed from a tabfile job"""
+    def __init__(self, job):
+        cl = job.command.split(' ')
+        self.job = job
+        self.name = job.comment
+        self.command = job.command
+        self.script = basename(cl[1])
+        self.options = cl[2: cl.index('>>')]
+        self.log = cl[cl.index('>>')+1]
+        self.celery = '--celery' in self.options
+        self.dry_run = '--dry-run' in self.options
+        self.catchup = '--catchup' in self.options
+
+        if '--device' in self.options:
+            self.device = int(self.options[self.options.index('--device')+1])
+        else:
+            self.device = None
+
+        if '--batch' in self.options:
+            self.batch = int(self.options[self.options.index('--batch')+1])
+        else:
+            self.batch = None
+
+        if '--devices' in self.options:
+            self._devices = [int(device) for device in self.options[self.options.index('--devices')+1].split(',')]
+        else:
+            self._devices = None
+
+    @property
+    def devices(self):
+        # Read when run, the devices of a batch change without the tabfile
+        if self.batch is not None: return batch_devices(self.batch)
+        return self._devices
+
+    @property
+    def in_process(self):
+        if self.batch is not None or self._devices is not None:
+            return self.script == f'{config._device_processor}.py'
+        return self.device is not None and self.script in _runners
+
+class Dispatcher(object):
+    """
+        Long-running dispatcher that runs the tasks of a tabfile
+        from a single warm process instead of one cron line each
+    """
+    def __init__(self, tabfile = None, workers = None):
+
+        if tabfile is None:
+            self.tabfile = join(config.paths['tabs'], f'{config._tabfile}.tab')
+        else:
+            self.tabfile = tabfile
+
+        if workers is None:
+            self.workers = config._dispatcher_workers
+        else:
+            self.workers = workers
+
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.entries = {}
+        self.running = {}
+        self.heap = []
+        self.mtime = None
+        self.installed = False
+
+    def load(self, now):
+        '''
+            Re-reads the tabfile if it changed and rebuilds the heap
+            of next-run times
+        '''
+        mtime = getmtime(self.tabfile)
+        if mtime == self.mtime: return False
+
+        self.mtime = mtime
+        self.installed = False
+        self.entries = {}
+        self.heap = []
+
+        for job in CronTab(tabfile=self.tabfile):
+            if job.comment.startswith(config._dispatcher):
+                self.installed = True
+                continue
+            if not job.is_enabled() or not job.is_valid(): continue
+            if '>>' not in job.command: continue
+
+            entry = DispatchEntry(job)
+            self.entries[entry.name] = entry
+            run = next_run(job, now)
+            if run is not None:
+                heappush(self.heap, (run, entry.name))
+
+        logger.info(f'Loaded {len(self.entries)} tasks from {self.tabfile}')
+        return True
+
+    def _run_in_process(self, entry):
+        # Route the records of this task to its log, as cron would. From any
+        # logger (i.e. scdata), and from the threads it starts (asyncio.to_thread)
+        rotate(entry.log)
+        handler = logging.FileHandler(entry.log)
+        handler.setFormatter(logging_formatter())
+        handler.addFilter(lambda record: _running.get() == entry.name)
+        root = logging.getLogger()
+        root.addHandler(handler)
+        token = _running.set(entry.name)
+        start = perf_counter()
+
+        try:
+            if entry.devices is not None:
+                asyncio.run(_batch_runner(entry.devices, entry.dry_run, catchup=entry.catchup))
+            elif entry.script == f'{config._device_processor}.py':
+                asyncio.run(_runners[entry.script](entry.device, entry.dry_run, catchup=entry.catchup))
+            else:
+                asyncio.run(_runners[entry.script](entry.device, catchup=entry.catchup))
+        except Exception:
+            logger.exception(f'Task {entry.name} failed')
+        finally:
+            _running.reset(token)
+            root.removeHandler(handler)
+            handler.close()
+            record_duration(entry.name, perf_counter() - start)
+            flush_runs()
+
+    def _run_subprocess(self, entry):
+        start = perf_counter()
+        subprocess.call(entry.command, shell=True)
+        record_duration(entry.name, perf_counter() - start)
+
+    def submit(self, entry):
+        if entry.name in self.running and not self.running[entry.name].done():
+            logger.warning(f'{entry.name} still running, skipping')
+            return
+
+        logger.info(f'Dispatching {entry.name}')
+
+        if entry.in_process and entry.celery:
+            if entry.devices is not None:
+                from scflows.tasks.celery_tasks import dprocess_batch_task
+                dprocess_batch_task.delay(devices=entry.devices, dry_run=entry.dry_run, catchup=entry.catchup)
+            elif entry.script == f'{config._device_processor}.py':
+                from scflows.tasks.celery_tasks import dprocess_task
+                dprocess_task.delay(device=entry.device, dry_run=entry.dry_run, catchup=entry.catchup)
+            else:
+                from scflows.tasks.celery_tasks import dbackup_task
+                dbackup_task.delay(device=entry.device, catchup=entry.catchup)
+        elif entry.in_process:
+            self.running[entry.name] = self.pool.submit(self._run_in_process, entry)
+        else:
+            self.running[entry.name] = self.pool.submit(self._run_subprocess, entry)
+
+    def dispatch(self, now):
+        '''
+            Submits all due tasks and returns the seconds until the next one
+        '''
+        while self.heap and self.heap[0][0] <= now:
+            run, name = heappop(self.heap)
+            entry = self.entries[name]
+            self.submit(entry)
+            _next = next_run(entry.job, max(run, now))
+            if _next is not None:
+                heappush(self.heap, (_next, name))
+
+        # Drop finished futures
+        self.running = {k: v for k, v in self.running.items() if not v.done()}
+
+        if not self.heap: return config._dispatcher_poll_seconds
+        return min((self.heap[0][0] - now).total_seconds(), config._dispatcher_poll_seconds)
+
+    def start(self):
+        logger.info(f'Starting dispatcher with {self.workers} workers')
+
+        while True:
+            now = datetime.now()
+            if self.load(now) and not self.installed:
+                logger.info('Dispatcher removed from tabfile. Stopping')
+                break
+            sleep(max(self.dispatch(now), 1))
+            rotate_output()
+
+        self.pool.shutdown(wait=True)
+
+if __name__ == '__main__':
+
+    if '-h' in sys.argv or '--help' in sys.argv or '-help' in sys.argv:
+        print('dispatcher: Run the tasks of the tabfile from a single long-running process')
+        print('USAGE:\n\rdispatcher.py [options]')
+        print('options:')
+        print('--workers <workers>: number of tasks run concurrently (default: config._dispatcher_workers)')
+        sys.exit()
+
+    # Archive the log of this task if it's too big or old
+    rotate_output()
+
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers')+1])
+    else:
+        workers = None
+
+    d = Dispatcher(workers=workers)
+
+    if not exists(d.tabfile):
+        logger.error(f'Tabfile not found: {d.tabfile}')
+        sys.exit()
+
+    # Cron relaunches the dispatcher every minute: only one may run
+    lock = open(f'{d.tabfile}.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        sys.exit()
+
+    d.start()
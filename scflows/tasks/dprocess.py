@@ -1,21 +1,43 @@
-import scdata as sc
-
 import sys
+import time
 import asyncio
-from scflows.worker import app
+from os.path import basename
 from scflows.config import config
-from scflows.custom_logger import logger
-from celery.result import AsyncResult
-from celery.exceptions import Ignore
-from celery import states
-
-async def dprocess(device, dry_run = False):
+from scflows.custom_logger import logger, set_log_fields
+from scflows.tools import LazyCallable
+from scflows.tasks.durations import record_duration
+from scflows.tasks.stages import Stages
+from scflows.tasks.metrics import record_task, count_retries
+from scflows.tasks.preflight import nothing_to_process
+from scflows.tasks.plans import apply_plan
+from scflows.logs import rotate_output
+
+# Heavy dependencies are only imported when the task is run
+Device = LazyCallable('scdata.Device')
+APIParams = LazyCallable('scdata.APIParams')
+record_run = LazyCallable('scflows.tasks.history.record_run')
+load_readings = LazyCallable('scflows.tasks.readings.load_readings')
+prepend_tail = LazyCallable('scflows.tasks.tails.prepend_tail')
+save_tail = LazyCallable('scflows.tasks.tails.save_tail')
+post_pending = LazyCallable('scflows.tasks.posting.post_pending')
+
+# Retries when posting are only reported in the connector logs
+count_retries()
+
+async def dprocess(device, dry_run = False, catchup = False, budget = None):
     '''
         This function processes a device from SC API assuming there
         is postprocessing information in it and that it's valid for doing
-        so
+        so. In catchup mode, it keeps processing windows of up to
+        config._max_load_amount rows until there is no more data or the
+        time budget (seconds) is over. Returns the task log, state and the
+        timing of each stage
     '''
+    if budget is None:
+        budget = config._catchup_budget_seconds
+
     task_log = []
+    task_stages = Stages()
 
     def logger_handler(msg, level='info'):
         if level == 'info':
@@ -26,10 +48,106 @@ async def dprocess(device, dry_run = False):
             logger.error(msg)
         return f'{level}: {msg}'
 
+    # Records of this device (its own asyncio task) carry these fields
+    set_log_fields(device=device, task='process')
+
     logger_handler(f'Processing instance for device {device}')
 
-    # Create device from SC API
-    d = sc.Device(params=sc.APIParams(id=device))
+    def conclude(task_state):
+        task_log.append(logger_handler(f'Stages: {task_stages}'))
+        task_log.append(logger_handler(f'Concluded job for {device}'))
+
+        summary = task_stages.summary()
+        record_task('process', task_state, summary)
+        record_run(device, 'process', task_state, summary)
+
+        return task_log, task_state, summary
+
+    async def process_window(d):
+        '''
+            Loads, processes and posts the data from d.options.min_date,
+            up to d.options.limit rows. Returns the state and the rows loaded
+        '''
+        task_state = [None, None]
+
+        with task_stages.stage('load') as stage:
+            loaded = await load_readings(d, stage)
+            stage['rows'] = len(d.data.index)
+            stage['channels'] = len(d.data.columns)
+        rows = len(d.data.index)
+
+        if loaded:
+            task_log.append(logger_handler(f'Device was loaded: {d.loaded}'))
+
+            # Process it, after the last rows of the previous run if the metrics look back
+            with task_stages.stage('process') as stage:
+                tail = prepend_tail(d)
+                stage['tail_rows'] = len(d.data.index) - rows
+                processed = d.process()
+                stage['metrics'] = len(d.metrics)
+
+            if processed:
+                task_log.append(logger_handler(f'Device was processed: {d.processed}'))
+
+                # The tail was already posted
+                data = d.data
+                if tail is not None: d.data = d.data[d.data.index > tail]
+                if d.data.empty:
+                    task_log.append(logger_handler(f'Device {device} has no new data. Nothing to do', 'warning'))
+                    return ['ABORTED', 'NO_NEW_DATA'], rows
+
+                # Update postprocessing date
+                d.update_postprocessing_date()
+
+                # Post results, with the postprocessing date as checkpoint
+                if d.postprocessing_updated:
+                    with task_stages.stage('post') as stage:
+                        columns = [metric.name for metric in d.metrics if metric.name in d.data.columns]
+                        stage['rows'] = len(d.data.index)
+                        # In-memory size of the posted columns
+                        stage['bytes'] = int(d.data[columns].memory_usage(deep=True).sum())
+                        if config._diff_posting:
+                            # Only rows not posted yet, or changed
+                            posted = await post_pending(d, dry_run, stage)
+                            # The stage adds up the windows of a catch-up once it's done
+                            counts = stage['posted_rows'], stage['skipped_rows']
+                        else:
+                            posted = await d.post(columns = 'metrics', dry_run=dry_run, max_retries=3, with_postprocessing=True)
+
+                    if posted:
+                        task_log.append(logger_handler(f'Device {device} was posted'))
+                        if config._diff_posting:
+                            task_log.append(logger_handler(f"Posted {counts[0]} rows, skipped {counts[1]}"))
+                        task_state = ['SUCCESS', 'PROCESSED AND UPLOADED']
+                        save_tail(d, data)
+                    else:
+                        task_state = ['FAILED', 'DATA_POSTING_FAILED']
+                else:
+                    task_log.append(logger_handler(f'Device {device} was not posted', 'warning'))
+                    task_state = ['ABORTED', 'POSTPROCESSING_UPDATE_FAILED']
+            else:
+                task_state = ['ABORTED', 'PROCESSING_FAILED']
+        else:
+            task_log.append(logger_handler(f'Device {device} was not loaded', 'warning'))
+
+            if d.data.empty:
+                task_log.append(logger_handler(f'Device {device} data is empty. Nothing to do', 'warning'))
+                task_state = ['ABORTED', 'EMPTY_DATA']
+
+        return task_state, rows
+
+    # Nothing new since the latest postprocessing, without loading scdata
+    if config._preflight:
+        with task_stages.stage('preflight'):
+            idle = await asyncio.to_thread(nothing_to_process, device)
+
+        if idle:
+            task_log.append(logger_handler(f'Device {device} has no new data. Nothing to do', 'warning'))
+            return conclude(['ABORTED', 'NO_NEW_DATA'])
+
+    # Create device from SC API. Metadata requests are blocking, keep the loop free
+    with task_stages.stage('init'):
+        d = await asyncio.to_thread(Device, params=APIParams(id=device))
     task_state = [None, None]
 
     if d:
@@ -39,44 +157,43 @@ async def dprocess(device, dry_run = False):
             d.options.min_date = d.handler.postprocessing['latest_postprocessing']
             task_log.append(logger_handler(f'Setting min_date as: {d.options.min_date }'))
 
-        # Only load data that is used in the metrics
-        d.options.channels = sorted([item for item in set([metric.kwargs['channel'] for metric in d.metrics if 'channel' in metric.kwargs]) if item is not None])
-        # Add channels that need to be eager loaded because they are potentially needed
-        d.options.channels += [item for sublist in [metric.kwargs['eager_channels'] for metric in d.metrics if 'eager_channels' in metric.kwargs] for item in sublist if item is not None]
+        # Only load data that is used in the metrics (eager channels last, because they are
+        # potentially needed), with the plan shared by devices with the same postprocessing
+        apply_plan(d)
 
         d.options.limit = config._max_load_amount
 
         if d.valid_for_processing:
             task_log.append(logger_handler('Device is valid for processing. Attempting load'))
 
-            if await d.load():
-                task_log.append(logger_handler(f'Device was loaded: {d.loaded}'))
-
-                # Process it
-                if d.process():
-                    task_log.append(logger_handler(f'Device was processed: {d.processed}'))
-
-                    # Update postprocessing date
-                    d.update_postprocessing_date()
-
-                    # Post results
-                    if d.postprocessing_updated:
-                        if await d.post(columns = 'metrics', dry_run=dry_run, max_retries=3, with_postprocessing=True):
-                            task_log.append(logger_handler(f'Device {device} was posted'))
-                            task_state = ['SUCCESS', 'PROCESSED AND UPLOADED']
-                        else:
-                            task_state = ['FAILED', 'DATA_POSTING_FAILED']
-                    else:
-                        task_log.append(logger_handler(f'Device {device} was not posted', 'warning'))
-                        task_state = ['ABORTED', 'POSTPROCESSING_UPDATE_FAILED']
-                else:
-                    task_state = ['ABORTED', 'PROCESSING_FAILED']
-            else:
-                task_log.append(logger_handler(f'Device {device} was not loaded', 'warning'))
-
-                if d.data.empty:
-                    task_log.append(logger_handler(f'Device {device} data is empty. Nothing to do', 'warning'))
-                    task_state = ['ABORTED', 'EMPTY_DATA']
+            start = time.perf_counter()
+            windows = 0
+            while True:
+                previous = task_state
+                task_state, rows = await process_window(d)
+                windows += 1
+
+                # The previous window was the last one with data
+                if windows > 1 and task_state[1] in ['EMPTY_DATA', 'NO_NEW_DATA']:
+                    task_log.append(logger_handler(f'Device {device} caught up in {windows-1} windows'))
+                    task_state = previous
+                    break
+                if not catchup or task_state[0] != 'SUCCESS': break
+
+                # Less than a full window left, or no progress
+                latest = d.handler.postprocessing['latest_postprocessing']
+                if rows < d.options.limit or latest == d.options.min_date:
+                    task_log.append(logger_handler(f'Device {device} caught up in {windows} windows'))
+                    break
+                if time.perf_counter() - start > budget:
+                    task_log.append(logger_handler(f'Device {device} out of time after {windows} windows, continues in the next run', 'warning'))
+                    break
+
+                # Next window from the postprocessing date just posted
+                d.options.min_date = latest
+                task_log.append(logger_handler(f'Setting min_date as: {d.options.min_date }'))
+                # Keep only one window in memory
+                d.data = d.data.iloc[0:0]
         else:
             task_log.append(logger_handler(f'Device {device} not valid for processing', 'error'))
             task_state = ['ABORTED', 'NOT_VALID_FOR_PROCESSING']
@@ -84,28 +201,39 @@ async def dprocess(device, dry_run = False):
         task_log.append(logger_handler(f'Device {device} not valid', 'error'))
         task_state = ['ABORTED', 'DEVICE_NOT_VALID']
 
-    task_log.append(logger_handler(f'Concluded job for {device}'))
-
-    return task_log, task_state
-
-@app.task(bind=True,track_started=True, name='scflows.tasks.dprocess_task')
-def dprocess_task(self, device, dry_run=False):
-    result, state = asyncio.run(dprocess(device, dry_run))
-    logger.info('dprocess')
-    logger.info(result)
-    logger.info(state)
-
-    # Raise custom state
-    if state[0] != 'SUCCESS':
-
-        self.update_state(
-            state=state[0],
-            meta={'message': state[1]})
-        with self.app.events.default_dispatcher() as dispatcher:
-            dispatcher.send('task-custom_state', field1='value1', field2='value2')
+    return conclude(task_state)
 
-        raise Ignore()
-    return result
+async def dprocess_batch(devices, dry_run = False, concurrency = None, catchup = False, budget = None):
+    '''
+        This function processes a list of devices from SC API concurrently
+        in the same event loop, with at most `concurrency` devices at a time.
+        In catchup mode, the time budget applies to each device.
+        Returns a list with the task_log, task_state and task_stages of each device
+    '''
+    if concurrency is None:
+        concurrency = config._batch_concurrency
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _dprocess(device):
+        async with semaphore:
+            try:
+                task_log, task_state, task_stages = await dprocess(device, dry_run, catchup, budget)
+            except Exception as e:
+                logger.exception(f'Device {device} failed')
+                task_log, task_state, task_stages = [f'error: {e}'], ['FAILED', 'EXCEPTION'], {}
+                record_task('process', task_state, task_stages)
+                record_run(device, 'process', task_state, task_stages)
+        return {'device': device, 'task_log': task_log, 'task_state': task_state, 'task_stages': task_stages}
+
+    return await asyncio.gather(*[_dprocess(device) for device in devices])
+
+def __getattr__(name):
+    # The celery tasks moved to celery_tasks
+    if name in ['dprocess_task', 'dprocess_batch_task']:
+        from scflows.tasks import celery_tasks
+        return getattr(celery_tasks, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 if __name__ == '__main__':
 
@@ -114,26 +242,85 @@ if __name__ == '__main__':
         print('USAGE:\n\rdprocess.py [options]')
         print('options:')
         print('--device <device-number>: device to process')
+        print('--devices <device-number>,<device-number>...: devices to process in batch')
+        print('--batch <index>: devices to process in batch, from the batches planned by dschedule')
+        print('--concurrency <concurrency>: devices processed at the same time in batch (default: config._batch_concurrency)')
+        print('--catchup: keep processing windows of config._max_load_amount rows until there is no more data')
+        print('--budget <seconds>: time budget of each device in catchup mode (default: config._catchup_budget_seconds)')
         print('--celery: task execution is managed via celery worker')
         print('--dry-run: dry run')
         sys.exit()
 
+    # Archive the log of this task if it's too big or old
+    rotate_output()
+
+    from scflows.tasks.scheduler import Task
+
     if '--dry-run' in sys.argv: dry_run = True
     else: dry_run = False
 
+    catchup = '--catchup' in sys.argv
+    if '--budget' in sys.argv:
+        budget = float(sys.argv[sys.argv.index('--budget')+1])
+    else:
+        budget = None
+
+    start = time.perf_counter()
     loop = asyncio.get_event_loop()
 
-    if '--device' in sys.argv:
+    if '--concurrency' in sys.argv:
+        concurrency = int(sys.argv[sys.argv.index('--concurrency')+1])
+    else:
+        concurrency = None
+
+    if '--batch' in sys.argv:
+        from scflows.tasks.batches import batch_devices
+        devices = batch_devices(int(sys.argv[sys.argv.index('--batch')+1]))
+        device = None
+    elif '--devices' in sys.argv:
+        devices = [int(device) for device in sys.argv[sys.argv.index('--devices')+1].split(',')]
+        device = None
+    elif '--device' in sys.argv:
         device = int(sys.argv[sys.argv.index('--device')+1])
+        devices = None
     else:
         logger.error('Missing device')
         sys.exit()
 
+    if devices is not None:
+        logger.info(f'Processing devices: {devices}')
+
+        if '--celery' in sys.argv:
+            logger.info(f'Using celery backend...')
+            from scflows.worker import app
+            from scflows.tasks.celery_tasks import dprocess_batch_task
+            from celery.result import AsyncResult
+            task_id = dprocess_batch_task.s().delay(devices = devices, dry_run = dry_run, concurrency = concurrency, catchup = catchup, budget = budget)
+            logger.info(f'Task ID: {task_id}')
+
+            # Wait for result
+            result = AsyncResult(task_id, app=app)
+            result.wait(timeout=60*len(devices))
+
+            logger.info('Task result:')
+            for res in result.get():
+                logger.info(f"{res['device']}: {res['task_state']}")
+        else:
+            loop.run_until_complete(dprocess_batch(devices, dry_run, concurrency, catchup, budget))
+
+        # Measured duration, for load balancing
+        record_duration(Task(script=basename(__file__), options=sys.argv[1:]).name, time.perf_counter() - start)
+        loop.close()
+        sys.exit()
+
     logger.info(f'Processing device: {device}')
 
     if '--celery' in sys.argv:
         logger.info(f'Using celery backend...')
-        task_id = dprocess_task.s().delay(device = device, dry_run = dry_run)
+        from scflows.worker import app
+        from scflows.tasks.celery_tasks import dprocess_task
+        from celery.result import AsyncResult
+        task_id = dprocess_task.s().delay(device = device, dry_run = dry_run, catchup = catchup, budget = budget)
         logger.info(f'Task ID: {task_id}')
 
         # Wait for result
@@ -141,11 +328,12 @@ if __name__ == '__main__':
         result.wait(timeout=60)
 
         logger.info('Task result:')
-        for res in result.get():
+        for res in result.get()['task_log']:
             logger.info(res)
+        logger.info(result.get()['task_stages'])
     else:
-        loop.run_until_complete(dprocess(device, dry_run))
+        loop.run_until_complete(dprocess(device, dry_run, catchup, budget))
 
+    # Measured duration, for load balancing
+    record_duration(Task(script=basename(__file__), options=sys.argv[1:]).name, time.perf_counter() - start)
     loop.close()
-
-
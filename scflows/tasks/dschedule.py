@@ -1,90 +1,183 @@
 from os.path import join, abspath, dirname
-from os import makedirs
+from datetime import datetime, timezone
 import sys
 import asyncio
+import time
 from requests import get
+from requests.exceptions import HTTPError
 from smartcitizen_connector import search_by_query
 from smartcitizen_connector.device import check_postprocessing
 from smartcitizen_connector.models import ReducedDevice
 from pydantic import TypeAdapter
 
 from scflows.config import config
-from scflows.tasks.scheduler import Scheduler, Task
-from scflows.worker import app
+from scflows.tasks.scheduler import Scheduler, Task, Plan
+from scflows.tasks.snapshot import DeviceSnapshot
+from scflows.tasks.batches import read_batches, write_batches, assign_batches
+from scflows.tasks.metrics import record_metrics
+from scflows.logs import rotate_output
 from scflows.custom_logger import logger
 
-async def check_and_schedule(device, interval_hours, task, dry_run, celery):
-
-    if task == 'process':
-        _,_,status = check_postprocessing(device.postprocessing)
-
-        if not status:
-            logger.warning(f'Device {device._name} has no valid postprocessing')
-            return
-
-    # Define task
-    task_options = [f'--device {device._name}']
+def device_task(device, task, dry_run, celery):
+    '''
+        Task and log file of a device
+    '''
+    task_options = [f'--device {device}']
 
     if celery: task_options.append('--celery')
     if dry_run: task_options.append('--dry-run')
 
-    #Create log output if not existing
-    dt = abspath(join(config.paths['public'], 'tasks', 'log', str(device._name)))
-    makedirs(dt, exist_ok=True)
+    # Log output, created when the task is added
+    dt = abspath(join(config.paths['public'], 'tasks', 'log', str(device)))
 
     if task == 'process':
         script = f'{config._device_processor}.py'
-        log = f"{join(dt, f'{config._device_processor}_{device._name}.log')}"
+        log = f"{join(dt, f'{config._device_processor}_{device}.log')}"
     elif task == 'backup':
         script = f'{config._device_storer}.py'
-        log = f"{join(dt, f'{config._device_storer}_{device._name}.log')}"
+        log = f"{join(dt, f'{config._device_storer}_{device}.log')}"
 
-    t = Task(script = script, options=task_options)
+    return Task(script = script, options=task_options), log
 
-    # Set scheduler
-    s = Scheduler()
+async def check_and_schedule(device, interval_hours, task, dry_run, celery, plan, semaphore, batch=False):
+    '''
+        Adds the task of a device to the plan, or its removal, and returns its state:
+        'invalid', 'no_readings', 'idle' or 'scheduled'. In batch mode, devices
+        to process are not scheduled individually, but grouped later on.
+        Blocking checks run in threads, bounded by the semaphore
+    '''
+
+    if task == 'process':
+        async with semaphore:
+            _,_,status = await asyncio.to_thread(check_postprocessing, device.postprocessing)
+
+        if not status:
+            logger.warning(f'Device {device._name} has no valid postprocessing')
+            return 'invalid'
+
+    # Define task
+    t, log = device_task(device._name, task, dry_run, celery)
+
+    # Tasks of the device with other options are replaced
+    for other in [(False, False), (False, True), (True, False), (True, True)]:
+        if other != (dry_run, celery): plan.drop(device_task(device._name, task, *other)[0].name)
 
     # TODO remove tasks for non-publishing devices?
     if task == 'process':
         if device.last_reading_at is None:
             logger.warning(f'Device {device._name} has no readings yet')
-            s.remove_task(t)
-            return
+            plan.drop(t.name)
+            return 'no_readings'
         else:
             if device.postprocessing['latest_postprocessing'] is None:
                 to_process = True
             else:
                 if device.postprocessing['latest_postprocessing'] > device.last_reading_at:
                     logger.warning(f'Device {device._name} has nothing to process. Remove')
-                    s.remove_task(t)
-                    return
+                    plan.drop(t.name)
+                    return 'idle'
                 else:
                     to_process = True
 
+        if to_process and batch:
+            # Batched later on, drop the individual task if there
+            plan.drop(t.name)
+            return 'scheduled'
+
         if to_process:
             # Schedule task
-            s.schedule_task(task=t,
+            plan.want(task=t,
                         log=log,
                         interval=f'{interval_hours}H',
                         load_balancing=True)
     else:
         if device.last_reading_at is None:
             logger.warning(f'Device {device._name} has no readings yet')
-            s.remove_task(t)
-            return
+            plan.drop(t.name)
+            return 'no_readings'
 
         # Schedule task
-        s.schedule_task(task=t,
+        plan.want(task=t,
                     log=log,
                     interval=f'{interval_hours}H',
                     load_balancing=True)
 
+    return 'scheduled'
+
+def postprocessed_since(postprocessing, since):
+    try:
+        return datetime.fromisoformat(postprocessing['updated_at'].replace('Z', '+00:00')) >= since
+    except (TypeError, KeyError, ValueError, AttributeError):
+        # Kept if it can't be told
+        return True
 
-async def dschedule(interval_hours, task='process', dry_run=False, celery=False):
+def task_options(dry_run, celery):
+    return ' '.join(option for option, on in [('--celery', celery), ('--dry-run', dry_run)] if on)
+
+def device_key(device, task, dry_run = False, celery = False):
+    '''
+        Summary of the fields and task options that decide how a device is
+        scheduled. If it didn't change since the last run, the device is skipped
+    '''
+    if task == 'process':
+        postprocessing = device.postprocessing
+        if device.last_reading_at is None:
+            hint = 'no_readings'
+        elif postprocessing['latest_postprocessing'] is not None and \
+            postprocessing['latest_postprocessing'] > device.last_reading_at:
+            hint = 'idle'
+        else:
+            hint = 'process'
+        fields = f"{postprocessing['hardware_url']}|{postprocessing['blueprint_url']}|{hint}"
+    else:
+        fields = 'readings' if device['last_reading_at'] is not None else 'no_readings'
+
+    return f'{fields}|{task_options(dry_run, celery)}'
+
+def schedule_batches(plan, devices, batch_size, interval_hours, dry_run, celery):
+    '''
+        Groups devices in batches of batch_size and plans one dprocess
+        --batch task per batch. Devices stay in their batch (see
+        assign_batches) and the devices of each batch are not in the
+        task, so batches only change when they are added or removed.
+        Returns the devices of each batch, to write once applied
+    '''
+    dt = abspath(join(config.paths['public'], 'tasks', 'log', 'batches'))
+    batches = assign_batches(read_batches(), devices, batch_size)
+
+    for index in batches:
+        task_options = [f'--batch {index}']
+
+        if celery: task_options.append('--celery')
+        if dry_run: task_options.append('--dry-run')
+
+        t = Task(script=f'{config._device_processor}.py', options=task_options)
+        log = join(dt, f'{config._device_processor}_batch_{index}.log')
+
+        plan.want(task=t,
+                    log=log,
+                    interval=f'{interval_hours}H',
+                    load_balancing=True)
+
+    # Batches no longer there, and batches by list of devices
+    for option in ['--batch', '--devices']:
+        plan.prune(f"{Task(script=f'{config._device_processor}.py', options=[option]).name}_")
+
+    logger.info(f'Planned {len(devices)} devices in {len(batches)} batches of {batch_size}')
+    return batches
+
+async def dschedule(interval_hours, task='process', dry_run=False, celery=False, batch_size=None, full=False, plan_only=False):
     '''
         This function schedules processing SC API devices based
         on the result of a global query for data processing
-        in the SC API
+        in the SC API. If batch_size is set, devices to process
+        are grouped in batch tasks instead of one task per device.
+        A local snapshot of the devices keeps track of the last run,
+        so that only devices that changed since then are fetched and
+        rescheduled, unless a full run is requested or due.
+        The changes are computed as a plan (tasks to add and remove),
+        and only the difference is applied. If plan_only, the plan
+        is returned without applying it
     '''
 
     if interval_hours is None:
@@ -95,26 +188,78 @@ async def dschedule(interval_hours, task='process', dry_run=False, celery=False)
         else:
             interval_hours = config._default_task_exec_interval_hours
 
+    start = time.perf_counter()
+    started = datetime.now(tz=timezone.utc)
+
+    snapshot = DeviceSnapshot(task)
+    full = full or snapshot.needs_full_run
+    # Devices scheduled with other options are all rescheduled
+    options = task_options(dry_run, celery)
+    if any(key.split('|')[-1] != options for key, _ in snapshot.devices.values()): full = True
+    logger.info(f'Scheduling with {"full" if full else "incremental"} device query')
+
+    # Parse the tabfile once and stage all changes until commit
+    s = Scheduler()
+    s.begin()
+    plan = Plan(s)
+
+    # Bound concurrent checks (API lookups and file system)
+    semaphore = asyncio.Semaphore(config._schedule_concurrency)
+    tasks = []
+    devices = []
+    found = set()
+
     if task == 'process':
-        df = search_by_query(endpoint='devices',
-                            search_items=[{
-                                'key': 'postprocessing_id',
-                                'value': 'not_null',
-                                'full': True
-                            }])
+        search_items = [{
+            'key': 'postprocessing_id',
+            'value': 'not_null',
+            'full': True
+        }]
+
+        if full:
+            df = search_by_query(endpoint='devices', search_items=search_items)
+        else:
+            # Only devices updated, with readings or postprocessed since the last run
+            df = None
+            since = snapshot.since.astimezone(timezone.utc)
+            for key in ['updated_at', 'last_reading_at', 'postprocessing_updated_at']:
+                try:
+                    _df = search_by_query(endpoint='devices',
+                        search_items=search_items + [{
+                            'key': key,
+                            'search_matcher': 'gteq',
+                            # Goes in the url as it is, without a + in the offset
+                            'value': since.strftime('%Y-%m-%dT%H:%M:%SZ')
+                        }])
+                except HTTPError as e:
+                    if key != 'postprocessing_updated_at': raise
+                    # Devices that went idle are then left to the next full run
+                    logger.warning(f'Devices by {key} not available: {e}')
+                    continue
+                if _df is None: continue
+                if key == 'postprocessing_updated_at':
+                    # In case the API ignores the condition
+                    _df = _df[[postprocessed_since(postprocessing, since) for postprocessing in _df['postprocessing']]]
+                df = _df if df is None else df.combine_first(_df)
+
         logger.info(df)
 
         # Check devices to postprocess first
-        tasks = []
-
-        for d in df.index:
-            tasks.append(check_and_schedule(device=df.loc[d,:],
-                interval_hours=interval_hours,
-                task=task,
-                dry_run=dry_run,
-                celery=celery))
-
-        await asyncio.gather(*tasks)
+        if df is not None:
+            for d in df.index:
+                found.add(int(d))
+                key = device_key(df.loc[d,:], task, dry_run, celery)
+                # Only check the devices that changed
+                if not full and not snapshot.changed(int(d), key): continue
+                devices.append((int(d), key))
+                tasks.append(check_and_schedule(device=df.loc[d,:],
+                    interval_hours=interval_hours,
+                    task=task,
+                    dry_run=dry_run,
+                    celery=celery,
+                    plan=plan,
+                    semaphore=semaphore,
+                    batch=batch_size is not None))
 
     elif task == 'backup':
         df = search_by_query(endpoint='users',
@@ -128,20 +273,61 @@ async def dschedule(interval_hours, task='process', dry_run=False, celery=False)
         logger.info(df)
 
         # Check devices to postprocess first
-        tasks = []
-
         for d in df.index:
             for device in df.loc[d, 'devices']:
+                found.add(device['id'])
+                key = device_key(device, task, dry_run, celery)
+                # Only validate the devices that changed
+                if not full and not snapshot.changed(device['id'], key): continue
                 _device = TypeAdapter(ReducedDevice).validate_python(device)
                 # Small dirty hack
                 _device._name = _device.id
+                devices.append((_device.id, key))
                 tasks.append(check_and_schedule(device=_device,
                     interval_hours=interval_hours,
                     task=task,
                     dry_run=dry_run,
-                    celery=celery))
+                    celery=celery,
+                    plan=plan,
+                    semaphore=semaphore))
+
+    states = await asyncio.gather(*tasks)
+
+    for (device, key), state in zip(devices, states):
+        snapshot.update(device, key, state)
+
+    # Devices not returned by a full query are gone
+    if full:
+        for device in [device for device in snapshot.devices if device not in found]:
+            logger.info(f'Device {device} no longer found. Remove')
+            plan.drop(device_task(device, task, dry_run, celery)[0].name)
+            snapshot.drop(device)
+
+    batches = None
+    if batch_size is not None and task == 'process':
+        batches = schedule_batches(plan, snapshot.scheduled(), batch_size, interval_hours, dry_run, celery)
+
+    logger.info(f'Plan:\n{plan}')
+
+    if plan_only:
+        s.rollback()
+        snapshot.close()
+        return plan
 
-        await asyncio.gather(*tasks)
+    # Apply only the difference, with a single write of the crontab
+    if plan.changed:
+        await asyncio.to_thread(plan.apply)
+    await asyncio.to_thread(s.commit)
+    if batches is not None: write_batches(batches)
+    snapshot.commit(started, full)
+    snapshot.close()
+
+    elapsed = time.perf_counter() - start
+    logger.info(f'Checked {len(tasks)} devices in {elapsed:.1f}s ({len(tasks)/elapsed:.1f} devices/s)')
+    record_metrics(counters = [('scflows_scheduler_devices_total', {'task': task}, len(tasks))],
+        observations = [('scflows_scheduler_seconds', {'task': task}, elapsed)])
+
+    return plan
 
 if __name__ == '__main__':
 
@@ -152,9 +338,15 @@ if __name__ == '__main__':
         print('--interval-hours [interval]: task execution interval in hours (default: config._default_task_exec_interval_hours)')
         print('--task [type]: task type. Either \'process\' or \'backup\'')
         print('--celery: subtask execution is managed via celery worker')
+        print('--batch-size <batch-size>: group devices to process in batch tasks of this size (default: one task per device)')
+        print('--full: query and check all devices, instead of only those changed since the last run')
+        print('--plan: print the tasks to add and remove, without applying them')
         print('--dry-run: dry run')
         sys.exit()
 
+    # Archive the log of this task if it's too big or old
+    rotate_output()
+
     if '--dry-run' in sys.argv: dry_run = True
     else: dry_run = False
 
@@ -171,9 +363,25 @@ if __name__ == '__main__':
     else:
         celery = False
 
-    logger.info(f'Parsing task with following arguments: dry_run={dry_run}, interval-hours={interval_hours}, celery={celery}')
+    if '--batch-size' in sys.argv:
+        batch_size = int(sys.argv[sys.argv.index('--batch-size')+1])
+    else:
+        batch_size = None
+
+    if '--full' in sys.argv:
+        full = True
+    else:
+        full = False
+
+    if '--plan' in sys.argv:
+        plan_only = True
+    else:
+        plan_only = False
+
+    logger.info(f'Parsing task with following arguments: dry_run={dry_run}, interval-hours={interval_hours}, celery={celery}, batch-size={batch_size}, full={full}, plan={plan_only}')
 
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(dschedule(interval_hours=interval_hours, task=task, dry_run=dry_run, celery=celery))
+    plan = loop.run_until_complete(dschedule(interval_hours=interval_hours, task=task, dry_run=dry_run, celery=celery, batch_size=batch_size, full=full, plan_only=plan_only))
+    if plan_only: print(plan)
     loop.close()
 
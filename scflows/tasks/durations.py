@@ -0,0 +1,47 @@
+from os.path import join
+import sqlite3
+
+from scflows.config import config
+
+class TaskDurations(object):
+    """
+        Measured run time of each task (by task name), smoothed over runs
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._task_durations)
+        else:
+            self.path = path
+
+        # Many tasks may finish at the same time
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS durations (
+                name TEXT PRIMARY KEY, seconds REAL, runs INTEGER)''')
+
+    def load(self):
+        return dict(self.conn.execute('SELECT name, seconds FROM durations'))
+
+    def record(self, name, seconds):
+        alpha = config._task_duration_smoothing
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO durations VALUES (?, ?, 1)
+                ON CONFLICT(name) DO UPDATE SET
+                    seconds = ? * excluded.seconds + (1 - ?) * seconds,
+                    runs = runs + 1''', (name, seconds, alpha, alpha))
+
+    def close(self):
+        self.conn.close()
+
+def record_duration(name, seconds):
+    '''
+        Stores the run time of a task. Never fails the task itself
+    '''
+    try:
+        durations = TaskDurations()
+        durations.record(name, seconds)
+        durations.close()
+    except sqlite3.Error:
+        pass
@@ -0,0 +1,190 @@
+from os.path import join
+from datetime import datetime, timedelta, timezone
+import threading
+import atexit
+import json
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Index, \
+    Integer, Float, String, Text, DateTime, select, func, case, desc
+from sqlalchemy.exc import SQLAlchemyError
+
+from scflows.config import config
+from scflows.custom_logger import logger
+
+metadata = MetaData()
+
+runs = Table('runs', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('device', Integer),
+    Column('task', String(20)),
+    Column('started', DateTime),
+    Column('finished', DateTime),
+    Column('seconds', Float),
+    Column('status', String(20)),
+    Column('state', String(50)),
+    Column('rows', Integer),
+    Column('stages', Text),
+    Index('ix_runs_device_started', 'device', 'started'),
+    Index('ix_runs_started', 'started'))
+
+# Runs that had nothing to do, the device is not behind
+IDLE = ['NO_NEW_DATA', 'EMPTY_DATA', 'DEVICE_NOT_VALID', 'NOT_VALID_FOR_PROCESSING']
+
+class RunHistory(object):
+    """
+        Outcome of each task run, in a local sqlite database shared by
+        all processes. Runs are buffered and written in batches
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._history)
+        else:
+            self.path = path
+
+        self.engine = create_engine(f'sqlite:///{self.path}', connect_args={'timeout': 30})
+        metadata.create_all(self.engine)
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def add(self, device, task, state, stages):
+        finished = datetime.now(tz=timezone.utc)
+        if stages:
+            started = datetime.fromisoformat(stages['started'])
+            seconds = stages['seconds']
+            rows = max([record.get('rows', 0) for record in stages['stages'].values()], default=0)
+        else:
+            started, seconds, rows = finished, None, None
+
+        with self.lock:
+            self.buffer.append({
+                'device': device,
+                'task': task,
+                'started': started,
+                'finished': finished,
+                'seconds': seconds,
+                'status': state[0],
+                'state': state[1],
+                'rows': rows,
+                'stages': json.dumps(stages['stages']) if stages else None
+            })
+            full = len(self.buffer) >= config._history_batch_size
+
+        if full: self.flush()
+
+    def flush(self):
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+        if not buffer: return
+
+        with self.engine.begin() as connection:
+            connection.execute(runs.insert(), buffer)
+
+    def slowest(self, since, limit = 20):
+        '''
+            Devices with the longest mean run time
+        '''
+        query = select(runs.c.device, runs.c.task,
+                func.count().label('runs'),
+                func.avg(runs.c.seconds).label('mean_seconds'),
+                func.max(runs.c.seconds).label('max_seconds'))\
+            .where(runs.c.started >= since)\
+            .group_by(runs.c.device, runs.c.task)\
+            .order_by(desc('mean_seconds'))\
+            .limit(limit)
+
+        with self.engine.connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(query)]
+
+    def failures(self, since):
+        '''
+            Share of the runs of each task type ending in each state
+        '''
+        query = select(runs.c.task, runs.c.status, runs.c.state, func.count().label('runs'))\
+            .where(runs.c.started >= since)\
+            .group_by(runs.c.task, runs.c.status, runs.c.state)
+
+        with self.engine.connect() as connection:
+            result = [dict(row._mapping) for row in connection.execute(query)]
+
+        totals = {}
+        for item in result:
+            totals[item['task']] = totals.get(item['task'], 0) + item['runs']
+        for item in result:
+            item['rate'] = item['runs'] / totals[item['task']]
+
+        return sorted(result, key=lambda item: (item['task'], -item['rate']))
+
+    def backlog(self, since):
+        '''
+            Runs, rows and devices left behind (last run of the day failed
+            or partial, idle runs don't count) per day and task type
+        '''
+        day = func.date(runs.c.started)
+        query = select(day.label('day'), runs.c.task,
+                func.count().label('runs'),
+                func.sum(case((runs.c.status == 'SUCCESS', 1), else_=0)).label('succeeded'),
+                func.coalesce(func.sum(runs.c.rows), 0).label('rows'))\
+            .where(runs.c.started >= since)\
+            .group_by(day, runs.c.task)\
+            .order_by(day)
+
+        # Last state of each device in each day
+        last = select(day.label('day'), runs.c.task, runs.c.device, runs.c.status, runs.c.state)\
+            .where(runs.c.started >= since)\
+            .order_by(runs.c.started)
+
+        with self.engine.connect() as connection:
+            result = {(row.day, row.task): dict(row._mapping) for row in connection.execute(query)}
+            states = {}
+            for row in connection.execute(last):
+                states[(row.day, row.task, row.device)] = (row.status, row.state)
+
+        for item in result.values():
+            item['pending'] = 0
+        for (_day, task, _), (status, state) in states.items():
+            if state in IDLE: continue
+            if status != 'SUCCESS' or (state or '').endswith('_PARTIAL'): result[(_day, task)]['pending'] += 1
+
+        return list(result.values())
+
+_history = None
+
+def history():
+    global _history
+    if _history is None:
+        _history = RunHistory()
+        atexit.register(flush_runs)
+    return _history
+
+def record_run(device, task, state, stages):
+    '''
+        Adds a run to the history. Never fails the task itself
+    '''
+    try:
+        history().add(device, task, state, stages)
+    except SQLAlchemyError:
+        logger.warning('Run could not be added to the history')
+
+def flush_runs():
+    '''
+        Writes the buffered runs. Long-running processes (celery workers,
+        the dispatcher) call it after each task
+    '''
+    if _history is None: return
+    try:
+        _history.flush()
+    except SQLAlchemyError:
+        logger.warning('Runs could not be written to the history')
+
+def query_history(query, days = None, limit = 20):
+    since = datetime.now(tz=timezone.utc) - timedelta(days=days or config._history_days)
+
+    if query == 'slowest':
+        return history().slowest(since, limit)
+    elif query == 'failures':
+        return history().failures(since)
+    elif query == 'backlog':
+        return history().backlog(since)
+
+    return None
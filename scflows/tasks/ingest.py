@@ -0,0 +1,246 @@
+from os.path import join, basename, dirname, getsize
+from os import makedirs, listdir, remove
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from glob import glob
+import sqlite3
+import gzip
+import json
+import sys
+import re
+
+import pandas as pd
+
+from scflows.config import config
+from scflows.custom_logger import logger
+from scflows.logs import archives
+
+# Lines of the CutsomLoggingFormatter, with or without colours
+LINE = re.compile(r'^(?:\x1b\[[\d;]*m)*\[(?P<time>[^\]]+)\] - (?P<name>\S+) - (?P<level>[A-Z]+) - (?P<message>.*?)(?:\x1b\[[\d;]*m)*$')
+
+# Messages of the tasks marking their final state
+STATES = [
+    (re.compile(r'Device \d+ was posted'), 'PROCESSED AND UPLOADED'),
+    (re.compile(r'Device was backed-up'), 'BACKUP_DONE'),
+    (re.compile(r'data is empty'), 'EMPTY_DATA'),
+    (re.compile(r'has no new data'), 'NO_NEW_DATA'),
+    (re.compile(r'not valid for processing'), 'NOT_VALID_FOR_PROCESSING'),
+    (re.compile(r'was not posted'), 'POSTPROCESSING_UPDATE_FAILED'),
+    (re.compile(r'Device \d+ not valid'), 'DEVICE_NOT_VALID')
+]
+CONCLUDED = 'Concluded job for'
+
+COLUMNS = ['device', 'file', 'offset', 'time', 'name', 'level', 'message', 'state', 'concluded']
+
+def parse_line(line):
+    '''
+        Time, name, level and message of a structured (JSON) or text
+        log line. None if it's not from the logger
+    '''
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(entry, dict) or 'message' not in entry: return None
+        return entry
+
+    match = LINE.match(line)
+    if match is None: return None
+    return match.groupdict()
+
+def parse_log(path, offset, archive = None):
+    '''
+        Parses the complete lines of a log (or of one of its archives)
+        after offset. Returns the columns of the parsed lines and the
+        offset to continue from. Lines that are not from the logger
+        (i.e. tracebacks) are skipped
+    '''
+    if archive is None:
+        size = getsize(path)
+        # Truncated since the last run
+        if size < offset: offset = 0
+
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            data = file.read(size - offset)
+    else:
+        with gzip.open(join(dirname(path), archive), 'rb') as file:
+            file.seek(offset)
+            data = file.read()
+
+    # Leave the last line if it's not complete yet
+    data = data[:data.rfind(b'\n') + 1]
+
+    # Per-device logs are in log/<device>/
+    try:
+        device = int(basename(dirname(path)))
+    except ValueError:
+        device = None
+
+    columns = {column: [] for column in COLUMNS}
+    position = offset
+    for raw in data.split(b'\n')[:-1]:
+        line = raw.decode('utf-8', errors='replace')
+        entry = parse_line(line)
+        if entry is not None:
+            message = entry['message']
+            state = next((state for pattern, state in STATES if pattern.search(message)), None)
+            columns['device'].append(entry.get('device', device))
+            columns['file'].append(archive or basename(path))
+            columns['offset'].append(position)
+            columns['time'].append(entry['time'])
+            columns['name'].append(entry['name'])
+            columns['level'].append(entry['level'])
+            columns['message'].append(message)
+            columns['state'].append(state)
+            columns['concluded'].append(message.startswith(CONCLUDED))
+        position += len(raw) + 1
+
+    return path, columns, offset + len(data), archive
+
+class LogIndex(object):
+    """
+        Columnar (parquet) index of the lines of the task logs, by device,
+        level and time. Each run only reads the bytes appended to each
+        log since the last one, and adds them as a new part
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._log_index)
+        else:
+            self.path = path
+
+        self.parts = join(self.path, 'parts')
+        makedirs(self.parts, exist_ok=True)
+
+        self.conn = sqlite3.connect(join(self.path, 'offsets.sqlite'), timeout=30)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS offsets (
+                file TEXT PRIMARY KEY, offset INTEGER, archived TEXT)''')
+        # End of the last archive ingested, in indexes from before archives were ingested
+        try:
+            self.conn.execute('ALTER TABLE offsets ADD COLUMN archived TEXT')
+        except sqlite3.OperationalError:
+            pass
+
+    def pending(self, root):
+        '''
+            Logs and archives with bytes not ingested yet, and where to start
+            from. Logs are rotated by copying and truncating them in place
+            (see logs.rotate), so the archives made since the last run are
+            ingested first, the oldest one from the offset in the log
+        '''
+        ingested = {file: (offset, archived) for file, offset, archived in
+            self.conn.execute('SELECT file, offset, archived FROM offsets')}
+        pending = []
+        for path in glob(join(root, '**', '*.log'), recursive=True):
+            offset, archived = ingested.get(path, (0, None))
+            rotated = [archive for archive in archives(path) if archived is None or archive['end'] > archived]
+            for archive in rotated:
+                pending.append((path, offset, archive))
+                offset = 0
+            if rotated or getsize(path) != offset:
+                pending.append((path, offset, None))
+        return pending
+
+    def ingest(self, root = None, workers = None):
+        '''
+            Parses the new lines of all logs under root in a pool of processes,
+            and writes them as a single part. Returns the number of lines
+        '''
+        if root is None: root = config.paths['log']
+
+        pending = self.pending(root)
+        if not pending:
+            logger.info('No new log lines')
+            return 0
+
+        logger.info(f'Ingesting {len(pending)} logs')
+        columns = {column: [] for column in COLUMNS}
+        offsets = {}
+        archived = {}
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            paths, starts, rotated = zip(*pending)
+            files = [archive['file'] if archive is not None else None for archive in rotated]
+            for (path, parsed, offset, file), archive in zip(pool.map(parse_log, paths, starts, files,
+                chunksize=max(1, len(pending)//64)), rotated):
+                for column in COLUMNS:
+                    columns[column] += parsed[column]
+                if archive is None: offsets[path] = offset
+                else: archived[path] = archive['end']
+
+        lines = len(columns['offset'])
+        if lines:
+            df = pd.DataFrame(columns)
+            df['device'] = df['device'].astype('Int64')
+            df['time'] = pd.to_datetime(df['time'], format='%Y-%m-%d %H:%M:%S,%f', errors='coerce')
+            df.to_parquet(join(self.parts, f"part-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.parquet"), index=False)
+
+        # Only once the part is written
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO offsets VALUES (?, ?, ?)
+                ON CONFLICT(file) DO UPDATE SET offset = excluded.offset,
+                    archived = COALESCE(excluded.archived, archived)''',
+                [(path, offset, archived.get(path)) for path, offset in offsets.items()])
+
+        if len(listdir(self.parts)) > config._log_index_parts:
+            self.compact()
+
+        logger.info(f'Ingested {lines} lines')
+        return lines
+
+    def compact(self):
+        '''
+            Merges all parts in one, sorted by device and time
+        '''
+        parts = sorted(glob(join(self.parts, 'part-*.parquet')))
+        df = pd.concat([pd.read_parquet(part) for part in parts]).sort_values(['device', 'time'])
+        df.to_parquet(join(self.parts, f"part-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.parquet"), index=False)
+        for part in parts: remove(part)
+
+    def query(self, device = None, level = None, start = None, end = None):
+        '''
+            Lines of the index, filtered by device, level and time
+        '''
+        filters = []
+        if device is not None: filters.append(('device', '==', device))
+        if level is not None: filters.append(('level', '==', level))
+        if start is not None: filters.append(('time', '>=', pd.Timestamp(start)))
+        if end is not None: filters.append(('time', '<', pd.Timestamp(end)))
+
+        if not listdir(self.parts): return pd.DataFrame(columns=COLUMNS)
+        return pd.read_parquet(self.parts, filters=filters or None)
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == '__main__':
+
+    if '-h' in sys.argv or '--help' in sys.argv or '-help' in sys.argv:
+        print('ingest: Index the lines of the task logs by device, level and time')
+        print('USAGE:\n\ringest.py [options]')
+        print('options:')
+        print('--workers <workers>: processes parsing the logs (default: number of cpus)')
+        print('--query: print the lines in the index instead, filtered by:')
+        print('\t--device <device>, --level <level>, --start <date>, --end <date>')
+        sys.exit()
+
+    def option(name, default = None):
+        if name in sys.argv: return sys.argv[sys.argv.index(name)+1]
+        return default
+
+    index = LogIndex()
+
+    if '--query' in sys.argv:
+        device = option('--device')
+        print(index.query(device=int(device) if device is not None else None,
+            level=option('--level'), start=option('--start'), end=option('--end')))
+    else:
+        workers = option('--workers')
+        index.ingest(workers=int(workers) if workers is not None else None)
+
+    index.close()
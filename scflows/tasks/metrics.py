@@ -0,0 +1,139 @@
+from os.path import join
+import logging
+import re
+import sqlite3
+
+from scflows.config import config
+
+# Name: (type, help)
+METRICS = {
+    'scflows_tasks_total': ('counter', 'Tasks run, by type and final state'),
+    'scflows_task_seconds': ('histogram', 'Run time of tasks, by type'),
+    'scflows_stage_seconds': ('histogram', 'Run time of each task stage, by type and stage'),
+    'scflows_rows_total': ('counter', 'Rows handled by each task stage, by type and stage'),
+    'scflows_api_retries_total': ('counter', 'Requests to the SC API that were retried'),
+    'scflows_scheduler_seconds': ('histogram', 'Run time of the scheduler, by type'),
+    'scflows_scheduler_devices_total': ('counter', 'Devices checked by the scheduler, by type')
+}
+
+_le = re.compile(r'le="([^"]*)",?')
+
+def _labels(labels):
+    # Rendered once and stored as is: 'a="1",b="2"'
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items()))
+
+class Metrics(object):
+    """
+        Counters and histograms shared by all processes (cron tasks,
+        dispatcher, celery workers) through a local sqlite file
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._metrics)
+        else:
+            self.path = path
+
+        # Many processes may write at the same time
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS samples (
+                name TEXT, labels TEXT, value REAL,
+                PRIMARY KEY (name, labels))''')
+
+    def _add(self, samples):
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO samples VALUES (?, ?, ?)
+                ON CONFLICT(name, labels) DO UPDATE SET
+                    value = value + excluded.value''', samples)
+
+    def inc(self, name, labels = {}, value = 1):
+        self._add([(name, _labels(labels), value)])
+
+    def observe(self, name, value, labels = {}):
+        # Cumulative buckets, as in the prometheus format
+        samples = [(f'{name}_bucket', _labels({**labels, 'le': le}), int(value <= le))
+            for le in config._metrics_buckets]
+        samples.append((f'{name}_bucket', _labels({**labels, 'le': '+Inf'}), 1))
+        samples.append((f'{name}_sum', _labels(labels), value))
+        samples.append((f'{name}_count', _labels(labels), 1))
+        self._add(samples)
+
+    def render(self):
+        '''
+            All samples in the prometheus text exposition format
+        '''
+        def order(row):
+            # Buckets of the same series in increasing le
+            name, labels, _ = row
+            match = _le.search(labels)
+            if match is None: return name, labels, 0
+            le = match.group(1)
+            return name, _le.sub('', labels), float('inf') if le == '+Inf' else float(le)
+
+        samples = {}
+        for name, labels, value in sorted(self.conn.execute('SELECT name, labels, value FROM samples'), key=order):
+            for suffix in ['_bucket', '_sum', '_count', '']:
+                if suffix and not name.endswith(suffix): continue
+                base = name[:len(name)-len(suffix)]
+                if base in METRICS: break
+            samples.setdefault(base, []).append(f'{name}{{{labels}}} {value:g}' if labels else f'{name} {value:g}')
+
+        lines = []
+        for base, (kind, description) in METRICS.items():
+            lines.append(f'# HELP {base} {description}')
+            lines.append(f'# TYPE {base} {kind}')
+            lines += samples.get(base, [])
+
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.conn.close()
+
+def record_metrics(counters = [], observations = []):
+    '''
+        Stores (name, labels, value) counters and observations.
+        Never fails the task itself
+    '''
+    try:
+        metrics = Metrics()
+        for name, labels, value in counters:
+            metrics.inc(name, labels, value)
+        for name, labels, value in observations:
+            metrics.observe(name, value, labels)
+        metrics.close()
+    except sqlite3.Error:
+        pass
+
+def record_task(task, state, stages):
+    '''
+        Final state, run time and stage timings of a task
+    '''
+    counters = [('scflows_tasks_total', {'task': task, 'state': state[1] or 'UNKNOWN'}, 1)]
+    observations = []
+
+    if stages:
+        observations.append(('scflows_task_seconds', {'task': task}, stages['seconds']))
+        for stage, record in stages['stages'].items():
+            observations.append(('scflows_stage_seconds', {'task': task, 'stage': stage}, record['seconds']))
+            if 'rows' in record:
+                counters.append(('scflows_rows_total', {'task': task, 'stage': stage}, record['rows']))
+
+    record_metrics(counters, observations)
+
+class RetryCounter(logging.Handler):
+    """
+        Counts the retries logged by the smartcitizen_connector,
+        as it doesn't report them otherwise
+    """
+    def emit(self, record):
+        if 'Retrying' in record.getMessage():
+            record_metrics(counters = [('scflows_api_retries_total', {}, 1)])
+
+def count_retries():
+    connector_logger = logging.getLogger('smartcitizen_connector')
+    if not any(isinstance(handler, RetryCounter) for handler in connector_logger.handlers):
+        connector_logger.addHandler(RetryCounter(logging.WARNING))
@@ -0,0 +1,127 @@
+from os.path import join
+from datetime import datetime, timedelta, timezone
+import threading
+import sqlite3
+import json
+
+from scflows.config import config
+from scflows.custom_logger import logger
+
+def identity(d):
+    '''
+        Postprocessing configuration of a device (hardware and blueprint)
+    '''
+    postprocessing = d.handler.postprocessing or {}
+    return f"{postprocessing.get('hardware_url')}|{postprocessing.get('blueprint_url')}"
+
+def build_plan(metrics):
+    '''
+        Channels to load (the ones used by the metrics, eager ones last, without
+        the ones computed by other metrics) and the order to evaluate the metrics
+        in, after the metrics they use
+    '''
+    names = [metric.name for metric in metrics]
+    uses = {}
+    channels, eager = [], []
+    for metric in metrics:
+        channel = metric.kwargs.get('channel')
+        eager_channels = [item for item in metric.kwargs.get('eager_channels') or [] if item is not None]
+        uses[metric.name] = [item for item in [channel] + eager_channels if item in names and item != metric.name]
+
+        # Metrics named as their channel (i.e. cleaned in place) still need it loaded
+        if channel is not None and (channel not in names or channel == metric.name): channels.append(channel)
+        eager += [item for item in eager_channels if item not in names or item == metric.name]
+
+    channels = sorted(set(channels))
+    channels += [item for item in dict.fromkeys(eager) if item not in channels]
+
+    # Metrics after the ones they use, otherwise in their order
+    order, visiting = [], set()
+
+    def visit(name):
+        if name in order: return
+        if name in visiting:
+            logger.warning(f'Circular metrics: {name}')
+            return
+        visiting.add(name)
+        for item in uses[name]: visit(item)
+        visiting.discard(name)
+        if name not in order: order.append(name)
+
+    for name in names: visit(name)
+
+    return {'channels': channels, 'order': order}
+
+class PlanCache(object):
+    """
+        Dependency plan of the metrics of each postprocessing configuration,
+        shared by all devices with it. Kept for config._plan_ttl_hours
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._plans)
+        else:
+            self.path = path
+
+        # Shared by the threads of the dispatcher
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS plans (
+                key TEXT PRIMARY KEY, plan TEXT, updated TEXT)''')
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        since = datetime.now(tz=timezone.utc) - timedelta(hours=config._plan_ttl_hours)
+        with self.lock:
+            if key in self.plans and self.plans[key][1] > since:
+                return self.plans[key][0]
+            row = self.conn.execute('SELECT plan, updated FROM plans WHERE key = ?', (key,)).fetchone()
+
+        if row is None or datetime.fromisoformat(row[1]) <= since: return None
+        plan = json.loads(row[0])
+        with self.lock:
+            self.plans[key] = (plan, datetime.fromisoformat(row[1]))
+        return plan
+
+    def put(self, key, plan):
+        updated = datetime.now(tz=timezone.utc)
+        with self.lock, self.conn:
+            self.plans[key] = (plan, updated)
+            self.conn.execute('INSERT OR REPLACE INTO plans VALUES (?, ?, ?)',
+                (key, json.dumps(plan), updated.isoformat()))
+
+    def close(self):
+        self.conn.close()
+
+_plans = None
+
+def plans():
+    global _plans
+    if _plans is None: _plans = PlanCache()
+    return _plans
+
+def apply_plan(d):
+    '''
+        Sets the channels to load and the order of the metrics of a device from
+        the plan of its postprocessing configuration, built if not there yet
+    '''
+    key = identity(d)
+    try:
+        plan = plans().get(key)
+    except sqlite3.Error:
+        plan = None
+
+    # Plans of other metrics (i.e. the blueprint changed) are rebuilt, kwargs only after the ttl
+    metrics = {metric.name: metric for metric in d.metrics}
+    if plan is None or len(plan['order']) != len(metrics) or any(name not in metrics for name in plan['order']):
+        plan = build_plan(d.metrics)
+        try:
+            plans().put(key, plan)
+        except sqlite3.Error:
+            logger.warning(f'Plan of {key} could not be stored')
+
+    d.metrics = [metrics[name] for name in plan['order']]
+    d.options.channels = list(plan['channels'])
+    return plan
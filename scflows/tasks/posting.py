@@ -0,0 +1,125 @@
+from os.path import join
+import threading
+import sqlite3
+
+import pandas as pd
+
+from scflows.config import config
+from scflows.custom_logger import logger
+
+def row_keys(index):
+    index = pd.DatetimeIndex(index)
+    index = index.tz_localize('UTC') if index.tz is None else index.tz_convert('UTC')
+    return list(index.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+
+def row_hashes(data):
+    # Content of each row, regardless of its time
+    return [int(value) for value in pd.util.hash_pandas_object(data, index=False).values.view('int64')]
+
+class PostedRows(object):
+    """
+        High-water mark (last time posted) and hash of the last rows posted of
+        each device, to post only rows that are new or changed since
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._posted)
+        else:
+            self.path = path
+
+        # Shared by the threads of the dispatcher
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS marks (
+                device INTEGER PRIMARY KEY, time TEXT);
+            CREATE TABLE IF NOT EXISTS hashes (
+                device INTEGER, time TEXT, hash INTEGER,
+                PRIMARY KEY (device, time));
+        ''')
+        self.lock = threading.Lock()
+
+    def pending(self, device, data):
+        '''
+            Rows of data after the high-water mark, or with a different
+            content than when they were posted
+        '''
+        keys = row_keys(data.index)
+        if not keys: return pd.Series(dtype=bool)
+
+        with self.lock:
+            mark = self.conn.execute('SELECT time FROM marks WHERE device = ?', (device,)).fetchone()
+            if mark is None: return pd.Series(True, index=data.index)
+            posted = dict(self.conn.execute(
+                'SELECT time, hash FROM hashes WHERE device = ? AND time >= ? AND time <= ?',
+                (device, min(keys), max(keys))))
+
+        pending = [key > mark[0] or (key in posted and posted[key] != value)
+            for key, value in zip(keys, row_hashes(data))]
+        return pd.Series(pending, index=data.index)
+
+    def record(self, device, data):
+        keys = row_keys(data.index)
+        if not keys: return
+
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                [(device, key, value) for key, value in zip(keys, row_hashes(data))])
+            self.conn.execute('''
+                INSERT INTO marks VALUES (?, ?)
+                ON CONFLICT(device) DO UPDATE SET time = MAX(time, excluded.time)''', (device, max(keys)))
+            # Only the last rows, the ones reloaded in overlaps
+            self.conn.execute('''
+                DELETE FROM hashes WHERE device = ? AND time < (
+                    SELECT MIN(time) FROM (
+                        SELECT time FROM hashes WHERE device = ? ORDER BY time DESC LIMIT ?))''',
+                (device, device, config._posted_rows))
+
+    def close(self):
+        self.conn.close()
+
+_posted = None
+
+def posted_rows():
+    global _posted
+    if _posted is None: _posted = PostedRows()
+    return _posted
+
+async def post_pending(d, dry_run = False, stage = None):
+    '''
+        Posts the metrics of the device that were not posted yet, or changed,
+        in batches of config._post_batch_rows. The postprocessing date goes with
+        the last batch. Counts the rows posted and skipped in stage, if given
+    '''
+    columns = [metric.name for metric in d.metrics if metric.name in d.data.columns]
+    data = d.data
+
+    try:
+        pending = data[posted_rows().pending(d.id, data[columns])]
+    except sqlite3.Error:
+        logger.warning(f'Posted rows of device {d.id} not available, posting all')
+        pending = data
+
+    # The postprocessing date still has to move forward
+    if pending.empty: pending = data.iloc[-1:]
+
+    if stage is not None:
+        stage['posted_rows'] = len(pending.index)
+        stage['skipped_rows'] = len(data.index) - len(pending.index)
+
+    batch = config._post_batch_rows
+    try:
+        for start in range(0, len(pending.index), batch):
+            d.data = pending.iloc[start:start + batch]
+            last = start + batch >= len(pending.index)
+            if not await d.post(columns = 'metrics', dry_run=dry_run, max_retries=3, with_postprocessing=last):
+                return False
+            if dry_run: continue
+            try:
+                posted_rows().record(d.id, d.data[columns])
+            except sqlite3.Error:
+                logger.warning(f'Posted rows of device {d.id} could not be recorded')
+    finally:
+        d.data = data
+
+    return True
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+from os import environ
+
+from requests import get
+from requests.exceptions import RequestException
+
+from scflows.config import config
+from scflows.custom_logger import logger
+
+def parse_date(value):
+    if value is None: return None
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None: date = date.replace(tzinfo=timezone.utc)
+    return date
+
+def device_metadata(device):
+    '''
+        Metadata of a device from a single request to the SC API, without
+        scdata. None if it can't be retrieved, so that the task goes ahead
+    '''
+    # Same as smartcitizen_connector
+    url = f"{environ.get('API_URL', config._api_url)}devices/{device}"
+    try:
+        response = get(url, timeout=config._preflight_timeout_seconds)
+        response.raise_for_status()
+        return response.json()
+    except (RequestException, ValueError) as e:
+        logger.warning(f'Device {device} metadata not available for pre-flight: {e}')
+        return None
+
+def last_reading(metadata):
+    return parse_date(metadata.get('last_reading_at'))
+
+def nothing_to_process(device):
+    '''
+        True if the device has no readings after its latest postprocessing
+    '''
+    metadata = device_metadata(device)
+    if metadata is None: return False
+
+    try:
+        last_reading_at = last_reading(metadata)
+        postprocessing = metadata.get('postprocessing') or {}
+        latest_postprocessing = parse_date(postprocessing.get('latest_postprocessing'))
+    except (TypeError, ValueError):
+        return False
+
+    # Devices without postprocessing are left to the task to report
+    if not postprocessing: return False
+    if last_reading_at is None: return True
+    if latest_postprocessing is None: return False
+
+    return latest_postprocessing >= last_reading_at
+
+def nothing_to_backup(device, last_requested_data):
+    '''
+        True if the readings of the device were already requested, or if the
+        next backup period is not complete yet
+    '''
+    metadata = device_metadata(device)
+    if metadata is None: return False
+
+    try:
+        last_reading_at = last_reading(metadata)
+    except (TypeError, ValueError):
+        return False
+
+    if last_reading_at is None: return True
+    # First backup of the device
+    if last_requested_data is None: return False
+    if last_requested_data.tzinfo is None:
+        last_requested_data = last_requested_data.replace(tzinfo=timezone.utc)
+    if last_requested_data >= last_reading_at: return True
+
+    return last_requested_data + timedelta(days=config._backup_interval_days) > datetime.now(tz=timezone.utc)
@@ -0,0 +1,280 @@
+from os.path import join, exists, getsize
+from os import makedirs, remove
+from datetime import datetime, timedelta, timezone
+import threading
+import sqlite3
+import fcntl
+
+import pandas as pd
+
+from scflows.config import config
+from scflows.custom_logger import logger
+
+# Coverage of loads with all the channels of a device (i.e. backups)
+ALL = '*'
+
+def merge(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def intersect(a, b):
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+        if start < end: result.append((start, end))
+        if a[i][1] < b[j][1]: i += 1
+        else: j += 1
+    return result
+
+def subtract(intervals, start, end):
+    result = []
+    for a, b in intervals:
+        if b <= start or a >= end:
+            result.append((a, b))
+            continue
+        if a < start: result.append((a, start))
+        if b > end: result.append((end, b))
+    return result
+
+def utc(date):
+    date = pd.Timestamp(date)
+    if date.tzinfo is None: return date.tz_localize('UTC')
+    return date.tz_convert('UTC')
+
+class ReadingsCache(object):
+    """
+        Local cache of the raw readings of the devices, in parquet files by
+        device and day, with the time ranges covered for each channel.
+        Shared by dprocess and dbackup, so that readings are only requested
+        from the API once. The least recently used days are evicted
+        over config._readings_cache_max_bytes
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['public'], config._readings_cache)
+        else:
+            self.path = path
+
+        makedirs(self.path, exist_ok=True)
+
+        # Shared by the threads of the dispatcher
+        self.conn = sqlite3.connect(join(self.path, 'coverage.sqlite'), timeout=30, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS coverage (
+                device INTEGER, channel TEXT, start TEXT, end TEXT);
+            CREATE INDEX IF NOT EXISTS ix_coverage_device ON coverage (device, channel);
+            CREATE TABLE IF NOT EXISTS partitions (
+                device INTEGER, day TEXT, bytes INTEGER, accessed TEXT,
+                PRIMARY KEY (device, day));
+        ''')
+        self.lock = threading.Lock()
+
+    def partition(self, device, day):
+        return join(self.path, str(device), f'{day}.parquet')
+
+    def coverage(self, device, channel):
+        return [(utc(start), utc(end)) for start, end in self.conn.execute(
+            'SELECT start, end FROM coverage WHERE device = ? AND channel = ? ORDER BY start',
+            (device, channel))]
+
+    def covered(self, device, channels):
+        '''
+            Time ranges covered for all the channels (None for all channels of the device)
+        '''
+        every = self.coverage(device, ALL)
+        if not channels: return every
+
+        result = None
+        for channel in channels:
+            intervals = merge(every + self.coverage(device, channel))
+            result = intervals if result is None else intersect(result, intervals)
+        return result
+
+    def segments(self, device, channels, start, end):
+        '''
+            Consecutive ranges between start and end, and whether they are cached
+        '''
+        start, end = utc(start), utc(end)
+        # Recent readings can still be uploaded late (i.e. from the SD card)
+        fresh = utc(datetime.now(tz=timezone.utc) - timedelta(hours=config._readings_cache_refetch_hours))
+        covered = intersect(self.covered(device, channels), [(start, min(end, fresh))])
+
+        segments = []
+        cursor = start
+        for a, b in covered:
+            if a > cursor: segments.append((cursor, a, False))
+            segments.append((a, b, True))
+            cursor = b
+        if cursor < end: segments.append((cursor, end, False))
+        return segments
+
+    def read(self, device, channels, start, end):
+        start, end = utc(start), utc(end)
+        # Partitions are by day in the timezone of the readings, one day around is enough
+        days = pd.date_range((start - timedelta(days=1)).floor('D'), (end + timedelta(days=1)).floor('D'), freq='D')
+
+        frames = []
+        accessed = datetime.now(tz=timezone.utc).isoformat()
+        for day in days:
+            path = self.partition(device, day.date().isoformat())
+            if not exists(path): continue
+            frames.append(pd.read_parquet(path))
+            with self.lock, self.conn:
+                self.conn.execute('UPDATE partitions SET accessed = ? WHERE device = ? AND day = ?',
+                    (accessed, device, day.date().isoformat()))
+
+        if not frames: return pd.DataFrame()
+
+        data = pd.concat(frames).sort_index()
+        data = data[(data.index >= start) & (data.index <= end)]
+        if channels: data = data[[channel for channel in channels if channel in data.columns]]
+        return data
+
+    def write(self, device, data, channels, start, end):
+        '''
+            Adds the readings loaded from the API between start and end,
+            and marks that range as covered for the channels
+        '''
+        start, end = utc(start), utc(end)
+        makedirs(join(self.path, str(device)), exist_ok=True)
+
+        # Other processes write to the same files
+        with open(join(self.path, '.lock'), 'w') as lock, self.lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            accessed = datetime.now(tz=timezone.utc).isoformat()
+            partitions = []
+            if not data.empty:
+                # Days in the timezone of the readings
+                for day, rows in data.groupby(data.index.floor('D')):
+                    path = self.partition(device, day.date().isoformat())
+                    if exists(path):
+                        # New readings take precedence
+                        rows = rows.combine_first(pd.read_parquet(path))
+                    rows.sort_index().to_parquet(path)
+                    partitions.append((device, day.date().isoformat(), getsize(path), accessed))
+
+            with self.conn:
+                for channel in (channels or [ALL]):
+                    intervals = merge(self.coverage(device, channel) + [(start, end)])
+                    self.conn.execute('DELETE FROM coverage WHERE device = ? AND channel = ?', (device, channel))
+                    self.conn.executemany('INSERT INTO coverage VALUES (?, ?, ?, ?)',
+                        [(device, channel, a.isoformat(), b.isoformat()) for a, b in intervals])
+                self.conn.executemany('INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?)', partitions)
+
+            self.evict()
+
+    def evict(self, max_bytes = None):
+        '''
+            Removes the least recently used days, and their coverage,
+            until the cache is under max_bytes
+        '''
+        if max_bytes is None: max_bytes = config._readings_cache_max_bytes
+
+        total = self.conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM partitions').fetchone()[0]
+        if total <= max_bytes: return
+
+        evicted = 0
+        for device, day, size in self.conn.execute(
+            'SELECT device, day, bytes FROM partitions ORDER BY accessed').fetchall():
+            if total <= max_bytes: break
+
+            path = self.partition(device, day)
+            if exists(path):
+                # The whole day, in the timezone of the readings
+                start = pd.read_parquet(path, columns=[]).index.min().floor('D')
+            else:
+                start = pd.Timestamp(day)
+            start = utc(start)
+            end = start + timedelta(days=1)
+
+            with self.conn:
+                for (channel,) in self.conn.execute(
+                    'SELECT DISTINCT channel FROM coverage WHERE device = ?', (device,)).fetchall():
+                    intervals = subtract(self.coverage(device, channel), start, end)
+                    self.conn.execute('DELETE FROM coverage WHERE device = ? AND channel = ?', (device, channel))
+                    self.conn.executemany('INSERT INTO coverage VALUES (?, ?, ?, ?)',
+                        [(device, channel, a.isoformat(), b.isoformat()) for a, b in intervals])
+                self.conn.execute('DELETE FROM partitions WHERE device = ? AND day = ?', (device, day))
+
+            if exists(path): remove(path)
+            total -= size
+            evicted += 1
+
+        logger.info(f'Evicted {evicted} days from the readings cache')
+
+    def close(self):
+        self.conn.close()
+
+_cache = None
+
+def readings_cache():
+    global _cache
+    if _cache is None: _cache = ReadingsCache()
+    return _cache
+
+async def load_readings(d, stage = None):
+    '''
+        Loads the readings of a device as d.load() does, from the local cache
+        for the ranges it covers and from the API for the rest, which are then
+        added to the cache. Counts the rows of each in stage, if given
+    '''
+    start = d.options.min_date or d.handler.json.created_at
+    end = d.handler.json.last_reading_at
+    if d.options.max_date is not None and end is not None: end = min(utc(d.options.max_date), utc(end))
+    if not config._readings_cache_enabled or start is None or end is None or utc(start) >= utc(end):
+        return await d.load()
+
+    cache = readings_cache()
+    channels = list(d.options.channels or [])
+    limit = d.options.limit
+    options = (d.options.min_date, d.options.max_date, d.options.limit)
+
+    data = pd.DataFrame()
+    rows = {'cached': 0, 'requested': 0}
+    try:
+        for a, b, cached in cache.segments(d.id, channels, start, end):
+            remaining = limit - len(data.index) if limit else None
+            if remaining is not None and remaining <= 0: break
+
+            if cached:
+                segment = cache.read(d.id, channels, a, b)
+                # One more, in case the first is the last of the previous range
+                if remaining is not None: segment = segment.iloc[:remaining + 1]
+                rows['cached'] += len(segment.index)
+            else:
+                d.options.min_date, d.options.max_date, d.options.limit = a, b, remaining
+                loaded = await d.load()
+                segment = d.data
+                if not loaded:
+                    # Stop at a failed load, not to leave a gap in the readings
+                    if not segment.empty: break
+                    # Empty or failed, it can't be told apart: not cached
+                    continue
+                # Limited loads only cover up to the last reading
+                covered = segment.index[-1] if remaining is not None and len(segment.index) >= remaining else b
+                cache.write(d.id, segment, channels, a, covered)
+                rows['requested'] += len(segment.index)
+
+            if segment.empty: continue
+            data = pd.concat([data, segment]) if not data.empty else segment
+            # Consecutive ranges share their limits
+            data = data[~data.index.duplicated(keep='last')]
+            if limit: data = data.iloc[:limit]
+    finally:
+        d.options.min_date, d.options.max_date, d.options.limit = options
+
+    d.data = data.sort_index()
+    d.loaded = not d.data.empty
+
+    if stage is not None:
+        stage['cached_rows'] = rows['cached']
+        stage['requested_rows'] = rows['requested']
+    return d.loaded
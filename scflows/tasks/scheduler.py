@@ -1,11 +1,17 @@
 from crontab import CronTab
 from os.path import join, realpath, dirname, abspath
+from os import replace, makedirs
+from contextlib import contextmanager
 import sys
+import sqlite3
 import subprocess
-from numpy import zeros, random, where
+from math import ceil
+from numpy import zeros, random, where, arange, concatenate, array
+from numpy.lib.stride_tricks import sliding_window_view
 
 from scflows.config import config
 from scflows.custom_logger import logger
+from scflows.tasks.durations import TaskDurations
 
 class Task(object):
     """Wrapper class for Tasks"""
@@ -28,28 +34,123 @@ class Scheduler(object):
             self.tabfile = tabfile
 
         self.cron = CronTab(tabfile=self.tabfile)
+        self._session = False
+        self._dirty = False
+        self._removed = set()
+        self._occupancy = None
+        self.durations = None
+        self._index()
+
+    def _index(self):
+        # Jobs keyed by comment (task name) for O(1) lookups
+        self.jobs = {}
+        for job in self.cron:
+            self.jobs.setdefault(job.comment, []).append(job)
+
+    def _apply_removals(self):
+        # Drop staged removals from the crontab in a single pass
+        if not self._removed: return
+        self.cron.crons[:] = [job for job in self.cron.crons if id(job) not in self._removed]
+        self.cron.lines[:] = [line for line in self.cron.lines if id(line) not in self._removed]
+        self._removed.clear()
+
+    def begin(self):
+        self._session = True
+
+    def commit(self):
+        self._session = False
+        if self._dirty:
+            self.write()
+        self._dirty = False
+
+    def rollback(self):
+        self._session = False
+        self._dirty = False
+        self._removed.clear()
+        self._occupancy = None
+        self.cron.read(self.tabfile)
+        self._index()
+
+    @contextmanager
+    def session(self):
+        '''
+            Stage all adds and removes in memory and write the crontab
+            only once when the session is committed
+        '''
+        self.begin()
+        try:
+            yield self
+        except Exception:
+            self.rollback()
+            raise
+        else:
+            self.commit()
+
+    def _span(self, task_name):
+        # Minutes a task runs for, based on its measured duration
+        if self.durations is None:
+            try:
+                self.durations = TaskDurations(join(dirname(self.tabfile), config._task_durations)).load()
+            except sqlite3.Error:
+                self.durations = {}
+        seconds = self.durations.get(task_name, config._default_task_duration_seconds)
+        return min(max(ceil(seconds/60), 1), 1440)
+
+    def _job_starts(self, job):
+        # Minutes of the day in which a job starts. None if it runs every minute
+        if job.special == '@reboot' or not job.is_enabled(): return None
+        minutes, hours = list(job.minute), list(job.hour)
+        if len(minutes) == 60 and len(hours) == 24: return None
+        return [hour*60 + minute for hour in hours for minute in minutes]
+
+    def _occupy(self, job, sign = 1):
+        starts = self._job_starts(job)
+        if starts is None: return
+        span = self._span(job.comment)
+        for start in starts:
+            self._occupancy[(start + arange(span)) % 1440] += sign
+
+    @property
+    def occupancy(self):
+        '''
+            Number of tasks running at each minute of the day, weighted
+            by their duration. Built once and then updated incrementally
+        '''
+        if self._occupancy is None:
+            self._occupancy = zeros(1440)
+            for jobs in self.jobs.values():
+                for job in jobs:
+                    self._occupy(job)
+        return self._occupancy
+
+    def place(self, period, span):
+        '''
+            Returns the start (minute of the day) within the first period
+            minutes, for a task running every period minutes during span
+            minutes, that minimises the peak of concurrently running tasks
+        '''
+        occupancy = self.occupancy
+        # Peak load in the window starting at each minute of the day
+        peak = sliding_window_view(concatenate([occupancy, occupancy[:span-1]]), span).max(axis=1)
+        peaks = array([peak[start::period].max() for start in range(period)])
+
+        # Random among the best slots
+        return int(random.choice(where(peaks == peaks.min())[0]))
 
     def check_slots(self, frequency = 'hourly'):
-        # Check frequency
+        # Load of each minute of the hour, or of each hour of the day
         if frequency == 'hourly':
-            sn = 60
-            fn = 8760
+            slots = self.occupancy.reshape(24, 60).sum(axis=0)
         elif frequency == 'daily':
-            sn = 24
-            fn = 365
-        # Check for slots
-        slots = zeros(sn)
-        for job in self.cron:
-            if job.frequency() == fn:
-                for part in job.minutes.parts:
-                    slots[part]+=1
+            slots = self.occupancy.reshape(24, 60).sum(axis=1)
 
         # Return a random slot
         return random.choice(where(slots == slots.min())[0])
 
     def list_tasks(self):
         tasks = []
-        for task in self.cron.comments:
+        for task in self.jobs:
+            if not task: continue
             logger.info(f'Found task: {task}')
             tasks.append(task)
 
@@ -68,30 +169,81 @@ class Scheduler(object):
             logger.error('No task provided')
             return
 
-        if self.cron.remove_all(comment=_tn):
+        jobs = self.jobs.pop(_tn, None)
+        if jobs:
+            self._removed.update(id(job) for job in jobs)
+            if self._occupancy is not None:
+                for job in jobs: self._occupy(job, -1)
             logger.info(f'Removed')
             self.write()
         else:
             logger.error(f'Task not found: {_tn}')
 
     def clear_tasks(self):
-        self.cron.remove_all()
+        for jobs in self.jobs.values():
+            self._removed.update(id(job) for job in jobs)
+        self.jobs = {}
+        self._occupancy = None
         self.write()
 
     def check_existing_task(self, task):
-        l = []
-        tasks = self.cron.find_comment(task.name)
-        for _task in tasks: l.append(_task)
-        if l:
+        if task.name in self.jobs:
             logger.info(f'{task.name} already running')
             return True
         else:
             logger.info(f'{task.name} not found')
             return False
 
+    def command(self, task, log):
+        return f"{sys.executable} {task.instruction} >> {log} 2>&1"
+
+    @staticmethod
+    def runs_every(job, interval):
+        '''
+            Whether a job runs on the interval it would be scheduled
+            with, wherever it was placed by load balancing
+        '''
+        every = int(interval[:-1])
+        dom = str(job.dom)
+        step = f'*/{every}' if every > 1 else '*'
+        hours = [part for part in job.hour.parts if isinstance(part, int)]
+
+        if interval.endswith('M'):
+            return str(job.minute) == step and str(job.hour) == '*' and dom == '*'
+        if interval.endswith('D'):
+            return dom == step and len(hours) == 1
+        if interval.endswith('H'):
+            if dom != '*' or not hours or len(hours) != len(job.hour.parts): return False
+            return sorted(hours) == list(range(min(hours), 24, every)) and min(hours) < every
+        return False
+
+    def matches(self, task, log, interval):
+        '''
+            Whether the jobs of a task run the same command on the same interval
+        '''
+        jobs = self.jobs.get(task.name)
+        if not jobs: return False
+        command = self.command(task, log)
+        return all(job.command == command and self.runs_every(job, interval) for job in jobs)
+
     def write(self):
-        self.cron.write_to_user(user=True)
-        self.cron.write(self.tabfile)
+        # Defer until commit if inside a session
+        if self._session:
+            self._dirty = True
+            return
+
+        self._apply_removals()
+
+        dispatcher = [job for name in self.jobs if name.startswith(config._dispatcher) for job in self.jobs[name]]
+        if dispatcher:
+            # Only the dispatcher goes to the user crontab, it runs the rest
+            CronTab(tab=''.join(f'{job.render()}\n' for job in dispatcher)).write_to_user(user=True)
+        else:
+            self.cron.write_to_user(user=True)
+        # Write to a temporary file and swap it in atomically
+        self.cron.write(f'{self.tabfile}.tmp')
+        replace(f'{self.tabfile}.tmp', self.tabfile)
+        self.cron.filen = self.tabfile
 
     def schedule_task(self, task, log, interval, force_first_run = False,\
         overwrite = False, load_balancing = False):
@@ -107,7 +259,7 @@ class Scheduler(object):
                 self.remove_task(task)
 
         # Make command
-        command = f"{sys.executable} {task.instruction} >> {log} 2>&1"
+        command = self.command(task, log)
 
         # Set cronjob
         job = self.cron.new(command=command, comment=task.name)
@@ -115,12 +267,21 @@ class Scheduler(object):
         # Workaround for parsing interval
         if interval.endswith('D'):
             job.every(int(interval[:-1])).days()
-            # If load balancing, add in low slot
+            # If load balancing, add in the least loaded slot
             if load_balancing:
-                job.hour.on(self.check_slots('daily'))
+                start = self.place(1440, self._span(task.name))
+                job.hour.on(start // 60)
+                job.minute.on(start % 60)
 
         elif interval.endswith('H'):
-            jobs_on=[item for item in range(random.randint(0, int(interval[:-1])-1),24,int(interval[:-1]))]
+            hours = int(interval[:-1])
+            # If load balancing, start in the least loaded slot
+            if load_balancing:
+                start = self.place(hours*60, self._span(task.name))
+            else:
+                start = random.randint(0, hours-1)*60
+
+            jobs_on=[item for item in range(start // 60, 24, hours)]
             # job.every(int(interval[:-1])).hours()
             job.hour.on(jobs_on[0])
 
@@ -128,14 +289,17 @@ class Scheduler(object):
                 for job_on in jobs_on[1:]:
                     job.hour.also.on(job_on)
 
-            # If load balancing, add in low slot
             if load_balancing:
-                job.minute.on(self.check_slots('hourly'))
+                job.minute.on(start % 60)
 
         elif interval.endswith('M'):
             job.every(int(interval[:-1])).minutes()
             # No load balance for minutes
 
+        self.jobs.setdefault(task.name, []).append(job)
+        if self._occupancy is not None:
+            self._occupy(job)
+
         self.write()
 
         # Workaround for macos?
@@ -147,5 +311,63 @@ class Scheduler(object):
 
         logger.info('Done')
 
+class Plan(object):
+    """
+        Reconciliation between the desired tasks and the tasks in the tabfile.
+        Only the difference is applied, so that existing tasks keep their slots
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.add = {}
+        self.remove = set()
+        self.unchanged = set()
+
+    def want(self, task, log, interval, load_balancing = False):
+        if self.scheduler.matches(task, log, interval):
+            self.unchanged.add(task.name)
+            self.remove.discard(task.name)
+            return
+
+        self.add[task.name] = (task, log, interval, load_balancing)
+        # Same task with another command or interval, replaced
+        if task.name in self.scheduler.jobs:
+            self.remove.add(task.name)
+        else:
+            self.remove.discard(task.name)
+
+    def drop(self, task_name):
+        if task_name in self.scheduler.jobs and task_name not in self.unchanged:
+            self.remove.add(task_name)
+        self.add.pop(task_name, None)
+
+    def prune(self, prefix):
+        '''
+            Removes the tasks starting with prefix that are not wanted
+        '''
+        for name in self.scheduler.jobs:
+            if name.startswith(prefix) and name not in self.unchanged:
+                self.remove.add(name)
+
+    @property
+    def changed(self):
+        return bool(self.add or self.remove)
+
+    def apply(self):
+        for name in sorted(self.remove):
+            self.scheduler.remove_task(task_name=name)
+
+        for task, log, interval, load_balancing in self.add.values():
+            makedirs(dirname(log), exist_ok=True)
+            self.scheduler.schedule_task(task=task,
+                log=log,
+                interval=interval,
+                load_balancing=load_balancing)
+
+    def __str__(self):
+        lines = [f'+ {name}' for name in sorted(self.add)]
+        lines += [f'- {name}' for name in sorted(self.remove)]
+        lines.append(f'{len(self.add)} to add, {len(self.remove)} to remove, {len(self.unchanged)} unchanged')
+        return '\n'.join(lines)
+
 if __name__ == '__main__':
     app.start()
\ No newline at end of file
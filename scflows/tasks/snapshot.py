@@ -0,0 +1,92 @@
+from os.path import join
+from datetime import datetime, timedelta, timezone
+import sqlite3
+
+from scflows.config import config
+
+class DeviceSnapshot(object):
+    """
+        Local snapshot of the devices seen by the last scheduling runs,
+        with the summary (key) and the scheduling state of each device
+    """
+    def __init__(self, task, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._device_snapshot)
+        else:
+            self.path = path
+
+        self.task = task
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS devices (
+                task TEXT, id INTEGER, key TEXT, state TEXT,
+                PRIMARY KEY (task, id));
+            CREATE TABLE IF NOT EXISTS runs (
+                task TEXT PRIMARY KEY, last_run TEXT, last_full_run TEXT);
+        ''')
+
+        self.devices = {}
+        for _id, key, state in self.conn.execute(
+            'SELECT id, key, state FROM devices WHERE task = ?', (task,)):
+            self.devices[_id] = (key, state)
+
+        self.last_run = None
+        self.last_full_run = None
+        row = self.conn.execute(
+            'SELECT last_run, last_full_run FROM runs WHERE task = ?', (task,)).fetchone()
+        if row is not None:
+            self.last_run = datetime.fromisoformat(row[0])
+            self.last_full_run = datetime.fromisoformat(row[1])
+
+        self._updated = {}
+        self._dropped = set()
+
+    @property
+    def needs_full_run(self):
+        if self.last_full_run is None: return True
+        return datetime.now(tz=timezone.utc) - self.last_full_run > \
+            timedelta(days=config._snapshot_full_run_interval_days)
+
+    @property
+    def since(self):
+        # Overlap a bit with the previous run, in case of clock differences
+        return self.last_run - timedelta(minutes=config._snapshot_overlap_minutes)
+
+    def changed(self, device, key):
+        if device not in self.devices: return True
+        return self.devices[device][0] != key
+
+    def update(self, device, key, state):
+        self.devices[device] = (key, state)
+        self._updated[device] = (key, state)
+
+    def drop(self, device):
+        self.devices.pop(device, None)
+        self._updated.pop(device, None)
+        self._dropped.add(device)
+
+    def scheduled(self):
+        return sorted(device for device, (_, state) in self.devices.items() if state == 'scheduled')
+
+    def commit(self, started, full):
+        '''
+            Stores the changes and the time the run started at
+        '''
+        with self.conn:
+            self.conn.executemany('DELETE FROM devices WHERE task = ? AND id = ?',
+                [(self.task, device) for device in self._dropped])
+            self.conn.executemany('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?)',
+                [(self.task, device, key, state) for device, (key, state) in self._updated.items()])
+
+            last_full_run = started if full else self.last_full_run
+            self.conn.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)',
+                (self.task, started.isoformat(), last_full_run.isoformat()))
+
+        self.last_run = started
+        self.last_full_run = last_full_run
+        self._updated = {}
+        self._dropped = set()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+import resource
+
+from scflows.custom_logger import log_fields
+
+def peak_rss():
+    # Peak resident memory of the process, in MB (ru_maxrss is in KB on linux)
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+class Stages(object):
+    """
+        Wall time and resources of each stage of a task.
+        Each stage can add its own counters (rows, channels, bytes...).
+        Repeated stages (i.e. windows of a catch-up) add up
+    """
+    additive = ['seconds', 'rows', 'bytes', 'cached_rows', 'requested_rows', 'tail_rows', 'posted_rows', 'skipped_rows']
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.started = datetime.now(tz=timezone.utc)
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        record = {}
+        start = perf_counter()
+        try:
+            with log_fields(stage=name):
+                yield record
+        finally:
+            record['seconds'] = round(perf_counter() - start, 3)
+            record['peak_rss_mb'] = peak_rss()
+            if name in self.stages:
+                previous = self.stages[name]
+                for key, value in previous.items():
+                    if key not in record: record[key] = value
+                    elif key in self.additive: record[key] = round(record[key] + value, 3)
+                    elif key != 'count': record[key] = max(record[key], value)
+                record['count'] = previous.get('count', 1) + 1
+            self.stages[name] = record
+
+    def summary(self):
+        return {
+            'started': self.started.isoformat(),
+            'seconds': round(perf_counter() - self.start, 3),
+            'peak_rss_mb': peak_rss(),
+            'stages': self.stages
+        }
+
+    def __str__(self):
+        return ', '.join(f"{name} {record['seconds']}s" for name, record in self.stages.items())
@@ -0,0 +1,113 @@
+from os.path import join, exists
+from os import makedirs, replace
+import math
+
+import pandas as pd
+
+from scflows.config import config
+from scflows.custom_logger import logger
+
+def frequency(d, data = None):
+    '''
+        Time between readings of a device, from its data or its options. None if unknown
+    '''
+    if data is None: data = d.data
+    if len(data.index) > 1:
+        step = pd.Series(data.index).diff().median()
+        if pd.notna(step) and step > pd.Timedelta(0): return step
+    try:
+        step = pd.Timedelta(pd.tseries.frequencies.to_offset(getattr(d.options, 'frequency', None)))
+    except (TypeError, ValueError):
+        return None
+    return step if pd.notna(step) else None
+
+def lookback(metrics, step = None):
+    '''
+        Rows before the new data that the metrics of a device need, from the
+        window they declare in their kwargs (config._tail_lookback_kwargs),
+        as rows or as time (i.e. '1h'), converted with the time between
+        readings (step)
+    '''
+    rows = [config._tail_min_rows]
+    for metric in metrics:
+        for kwarg in config._tail_lookback_kwargs:
+            value = metric.kwargs.get(kwarg)
+            if isinstance(value, int) and not isinstance(value, bool): rows.append(value)
+            elif isinstance(value, str) and step is not None:
+                try:
+                    rows.append(math.ceil(pd.Timedelta(pd.tseries.frequencies.to_offset(value)) / step))
+                except (TypeError, ValueError):
+                    logger.warning(f'Lookback {value} of metric {metric.name} not understood')
+    return max(rows)
+
+class TailCache(object):
+    """
+        Last processed rows (raw and metrics) of each device, so that metrics
+        with a lookback can be processed over the new data only
+    """
+    def __init__(self, path = None):
+
+        if path is None:
+            self.path = join(config.paths['tabs'], config._tails)
+        else:
+            self.path = path
+
+        makedirs(self.path, exist_ok=True)
+
+    def file(self, device):
+        return join(self.path, f'{device}.parquet')
+
+    def get(self, device):
+        if not exists(self.file(device)): return None
+        try:
+            return pd.read_parquet(self.file(device))
+        except (OSError, ValueError):
+            logger.warning(f'Tail of device {device} could not be read')
+            return None
+
+    def put(self, device, data, rows):
+        # Written aside and moved, not to leave a partial tail
+        tmp = f'{self.file(device)}.tmp'
+        data.iloc[-rows:].to_parquet(tmp)
+        replace(tmp, self.file(device))
+
+_tails = None
+
+def tails():
+    global _tails
+    if _tails is None: _tails = TailCache()
+    return _tails
+
+def prepend_tail(d):
+    '''
+        Adds the tail of the previous run before the loaded data, if it ends
+        where this load starts. Returns the last row of the tail, already
+        posted, or None
+    '''
+    if not config._tail_cache_enabled or not lookback(d.metrics, frequency(d)): return None
+
+    tail = tails().get(d.id)
+    if tail is None or tail.empty: return None
+
+    end = tail.index[-1]
+    # Only contiguous with the latest postprocessing, otherwise it's stale
+    if d.options.min_date is None or pd.Timestamp(d.options.min_date) != end:
+        return None
+
+    columns = [column for column in d.data.columns if column in tail.columns]
+    data = pd.concat([tail[columns], d.data])
+    d.data = data[~data.index.duplicated(keep='last')].sort_index()
+    return end
+
+def save_tail(d, data):
+    '''
+        Keeps the last rows of the processed data of a device, as many as its metrics need
+    '''
+    if not config._tail_cache_enabled: return
+    rows = lookback(d.metrics, frequency(d, data))
+    if not rows or data.empty: return
+    # Never fails the task itself
+    try:
+        tails().put(d.id, data, rows)
+    except (OSError, ValueError):
+        logger.warning(f'Tail of device {d.id} could not be stored')
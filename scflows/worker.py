@@ -6,8 +6,7 @@ app = Celery('scflows',
     broker=environ['CELERY_BROKER'],
     include=[
         # 'scflows.tasks.dschedule',
-        'scflows.tasks.dprocess',
-        'scflows.tasks.dbackup'])
+        'scflows.tasks.celery_tasks'])
 
 app.conf.timezone = environ['CELERY_TIMEZONE']
 